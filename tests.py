@@ -1,6 +1,10 @@
 import contextlib
 import io
+import json
 import os
+import shutil
+import subprocess
+import sys
 import tempfile
 import unittest
 from unittest import mock
@@ -228,6 +232,1093 @@ per-file-ignores =
             opts=["--multi-imports", "--black-line-length", "79"],
         )
 
+    @contextlib.contextmanager
+    def _copy_files(self, *filenames):
+        with tempfile.TemporaryDirectory() as tmp:
+            for filename in filenames:
+                shutil.copy(os.path.join("test_files", filename), tmp)
+            yield tmp
+
+    def _run_check(self, path, *opts):
+        with self._capture_stdout() as buf:
+            status = zimports.main(
+                [path, "--toml-config", "_fake.toml", "-W", "1"] + list(opts)
+            )
+        return status, buf.getvalue()
+
+    def _run_stderr(self, paths, *opts):
+        buf = io.StringIO()
+        with mock.patch("zimports.zimports.sys", mock.Mock(stderr=buf)):
+            status = zimports.main(
+                list(paths)
+                + ["--toml-config", "_fake.toml", "-W", "1"]
+                + list(opts)
+            )
+        return status, buf.getvalue()
+
+    def _run_records(self, paths, *opts):
+        """Run with ``--stats-format ndjson``, returning the exit status
+        and the parsed records of the files and the summary."""
+        status, output = self._run_stderr(
+            paths, "--stats-format", "ndjson", *opts
+        )
+        return status, [json.loads(line) for line in output.splitlines()]
+
+    def test_check_unchanged(self):
+        status, output = self._run_check("test_files/empty.py", "--check")
+        self.assertEqual(status, 0)
+        self.assertEqual(output, "")
+
+    def test_check_changed(self):
+        with self._copy_files("empty.py", "nosort.py") as tmp:
+            status, output = self._run_check(tmp, "--check")
+
+            self.assertEqual(status, 1)
+            self.assertEqual(output, "")
+            with (
+                open("test_files/nosort.py") as orig,
+                open(os.path.join(tmp, "nosort.py")) as checked,
+            ):
+                self.assertEqual(orig.read(), checked.read())
+
+    def test_list_changed(self):
+        with self._copy_files(
+            "empty.py", "nosort.py", "dupe_imports.py"
+        ) as tmp:
+            status, output = self._run_check(tmp, "--list-changed")
+            self.assertEqual(status, 1)
+            self.assertEqual(
+                sorted(output.split("\n")),
+                [
+                    "",
+                    os.path.join(tmp, "dupe_imports.py"),
+                    os.path.join(tmp, "nosort.py"),
+                ],
+            )
+
+            status, output = self._run_check(
+                tmp, "--list-changed", "--null", "--fail-fast"
+            )
+            self.assertEqual(status, 1)
+            self.assertEqual(output.count("\0"), 1)
+            self.assertTrue(output.endswith("\0"))
+
+    def test_list_changed_path_order(self):
+        with self._copy_files(
+            "nosort.py", "dupe_imports.py", "type_checking1.py"
+        ) as tmp:
+            status, output = self._run_check(tmp, "--list-changed", "-W", "2")
+            self.assertEqual(
+                output.split("\n")[:-1],
+                [
+                    os.path.join(tmp, "dupe_imports.py"),
+                    os.path.join(tmp, "nosort.py"),
+                    os.path.join(tmp, "type_checking1.py"),
+                ],
+            )
+
+    def test_files_from(self):
+        names = ["nosort.py", "empty.py", "type_checking1.py", "nosort.py"]
+        with self._copy_files(*set(names)) as tmp:
+            paths = [os.path.join(tmp, name) for name in names]
+            for null, workers in [(False, "1"), (True, "1"), (True, "2")]:
+                with open(os.path.join(tmp, "files.txt"), "wb") as file_:
+                    sep = b"\0" if null else b"\n"
+                    file_.write(sep.join(os.fsencode(p) for p in paths))
+                args = ["--files-from", os.path.join(tmp, "files.txt")]
+                if null:
+                    args.append("-0")
+                with self._capture_stdout() as buf:
+                    zimports.main(
+                        args
+                        + ["--toml-config", "_fake.toml", "-W", workers]
+                        + ["--list-changed"]
+                    )
+                self.assertEqual(
+                    buf.getvalue().split("\0" if null else "\n")[:-1],
+                    [paths[0], paths[2], paths[3]],
+                )
+
+    def test_checkpoint_resume(self):
+        with self._copy_files(
+            "nosort.py", "dupe_imports.py", "empty.py"
+        ) as tmp:
+            checkpoint = os.path.join(tmp, "checkpoint.jsonl")
+
+            def entries():
+                with open(checkpoint) as file_:
+                    header, *lines = file_.read().splitlines()
+                self.assertEqual(list(json.loads(header)), ["fingerprint"])
+                # leaving out a line cut short by a killed run
+                return [json.loads(line) for line in lines if line[-1:] == "}"]
+
+            self._run_check(tmp, "--checkpoint", checkpoint)
+            self.assertEqual(
+                [(e["path"], e["is_changed"]) for e in entries()],
+                [
+                    (os.path.join(tmp, "dupe_imports.py"), True),
+                    (os.path.join(tmp, "empty.py"), False),
+                    (os.path.join(tmp, "nosort.py"), True),
+                ],
+            )
+
+            # a run killed partway through writing a line
+            with open(checkpoint, "a") as file_:
+                file_.write('{"path": ')
+            with open(os.path.join(tmp, "empty.py"), "w") as file_:
+                file_.write("import os\n")
+
+            status, records = self._run_records(
+                [tmp], "--checkpoint", checkpoint, "--resume"
+            )
+            self.assertEqual(
+                [(r.get("resumed"), r["is_changed"]) for r in records[:-1]],
+                [(True, True), (None, True), (True, True)],
+            )
+            self.assertEqual(records[-1]["resumed"], 2)
+            self.assertEqual(status, 0)
+            self.assertEqual(
+                entries()[-1]["path"], os.path.join(tmp, "empty.py")
+            )
+
+            # a checkpoint written in another mode isn't resumed from, and
+            # is left as it was
+            with open(checkpoint, "rb") as file_:
+                before = file_.read()
+            for stats_format in ("text", "json"):
+                status, output = self._run_stderr(
+                    [tmp],
+                    "--checkpoint",
+                    checkpoint,
+                    "--resume",
+                    "--check",
+                    "--stats-format",
+                    stats_format,
+                )
+                self.assertEqual(status, 2)
+                self.assertEqual(
+                    output,
+                    f"zimports: error: {checkpoint} was written with "
+                    "different options or by another version; resume with "
+                    "the same options, or run without --resume to start it "
+                    "over\n",
+                )
+            with open(checkpoint, "rb") as file_:
+                self.assertEqual(file_.read(), before)
+
+            # resumed files are still echoed with --stdout, and changed
+            # ones are run again for their output
+            unchanged = os.path.join(tmp, "empty.py")
+            changed = os.path.join(tmp, "changed.py")
+            with open(unchanged, "w") as file_:
+                file_.write("import os\n\nos.sep  \n")
+            with open(changed, "w") as file_:
+                file_.write("import os\n")
+            self._run_check(unchanged, "--checkpoint", checkpoint, "--stdout")
+            self._run_check(
+                changed, "--checkpoint", checkpoint, "--stdout", "--resume"
+            )
+            stdout, stderr = io.StringIO(), io.StringIO()
+            with mock.patch(
+                "zimports.zimports.sys",
+                mock.Mock(stdout=stdout, stderr=stderr),
+            ):
+                zimports.main(
+                    [unchanged, changed, "--toml-config", "_fake.toml"]
+                    + ["--stdout", "--checkpoint", checkpoint, "--resume"]
+                    + ["-W", "1"]
+                )
+            self.assertEqual(stdout.getvalue(), "import os\n\nos.sep  \n")
+            lines = stderr.getvalue().splitlines()
+            self.assertEqual(
+                lines[0],
+                "[Resumed]       %s (recorded as unchanged)" % unchanged,
+            )
+            self.assertTrue(lines[1].startswith(f"[Generating]    {changed}"))
+            os.unlink(changed)
+
+            # files skipped by --per-file-timeout are tried again
+            self._run_check(
+                tmp,
+                "--checkpoint",
+                checkpoint,
+                "--per-file-timeout",
+                "0.000001",
+            )
+            self.assertEqual(entries(), [])
+
+    def test_time_budget(self):
+        with self._copy_files(
+            "nosort.py", "dupe_imports.py", "empty.py"
+        ) as tmp:
+            for age, filename in enumerate(
+                ["empty.py", "nosort.py", "dupe_imports.py"]
+            ):
+                os.utime(os.path.join(tmp, filename), (0, 1000000 - age))
+
+            def run(budget):
+                _, records = self._run_records(
+                    [tmp], "--check", "--time-budget", budget
+                )
+                return records
+
+            # most recently modified first
+            records = run("60")
+            self.assertEqual(
+                [os.path.basename(r["filename"]) for r in records[:-1]],
+                ["empty.py", "nosort.py", "dupe_imports.py"],
+            )
+            self.assertEqual(
+                records[-1]["budget"],
+                {"seconds": 60.0, "total": 3, "remaining": 0, "coverage": 1.0},
+            )
+
+            # then files with changes in git, then the rest; git is run
+            # in the repository of the paths, not the current directory
+            def git(*args):
+                subprocess.run(
+                    ["git", "-C", tmp, "-c", "user.name=zimports"]
+                    + ["-c", "user.email=zimports@example.com", *args],
+                    stdout=subprocess.DEVNULL,
+                    check=True,
+                )
+
+            git("init", "-q")
+            git("add", "empty.py", "nosort.py", "dupe_imports.py")
+            git("commit", "-q", "-m", "files")
+            filename = os.path.join(tmp, "dupe_imports.py")
+            with open(filename, "a") as file_:
+                file_.write("\n")
+            os.utime(filename, (0, 1000000 - 2))
+            records = run("60")
+            self.assertEqual(
+                [os.path.basename(r["filename"]) for r in records[:-1]],
+                ["dupe_imports.py", "empty.py", "nosort.py"],
+            )
+
+            # git is asked once for a repository, however many paths
+            from zimports.zimports import _git_state
+
+            paths = [
+                os.path.join(tmp, name)
+                for name in ("dupe_imports.py", "empty.py", "nosort.py")
+            ]
+            with mock.patch(
+                "zimports.zimports._git_state", wraps=_git_state
+            ) as git_state:
+                _, records = self._run_records(
+                    [tmp, *paths], "--check", "--time-budget", "60"
+                )
+            self.assertEqual(git_state.call_count, 1)
+            self.assertEqual(
+                os.path.basename(records[0]["filename"]), "dupe_imports.py"
+            )
+
+            # an exhausted budget starts nothing
+            records = run("0.000000001")
+            self.assertEqual(records[-1]["files"], 0)
+            self.assertEqual(records[-1]["budget"]["remaining"], 3)
+
+    def test_patch(self):
+        filenames = ("nosort.py", "dupe_imports.py", "type_checking1.py")
+        with self._copy_files(*filenames) as tmp:
+            cwd = os.getcwd()
+            os.chdir(tmp)
+            try:
+                status, output = self._run_check(
+                    ".", "--patch", "changes.patch", "-W", "2"
+                )
+            finally:
+                os.chdir(cwd)
+            self.assertEqual(status, 0)
+            self.assertEqual(output, "")
+
+            # files are left alone
+            for filename in filenames:
+                with (
+                    open(os.path.join("test_files", filename)) as orig,
+                    open(os.path.join(tmp, filename)) as checked,
+                ):
+                    self.assertEqual(orig.read(), checked.read())
+
+            subprocess.run(
+                ["git", "apply", "changes.patch"], cwd=tmp, check=True
+            )
+            # the patched files are what zimports would have written
+            status, output = self._run_check(tmp, "--check")
+            self.assertEqual(status, 0)
+
+    def test_decode_python_source(self):
+        import importlib.util
+
+        from zimports.zimports import _MMAP_THRESHOLD
+        from zimports.zimports import _parse_magic_encoding_comment
+        from zimports.zimports import _read_python_source
+
+        def decode_source(content):
+            # how files were decoded before the UTF-8 fast path
+            encoding = _parse_magic_encoding_comment(io.BytesIO(content))
+            text = importlib.util.decode_source(content)
+            return [line.rstrip() for line in text.split("\n")], encoding
+
+        cases = [
+            ("crlf", b"import os\r\nimport sys\r\n\r\nos, sys\r\n"),
+            ("bom", b"\xef\xbb\xbfimport os\n# \xc3\xa9\n"),
+            (
+                "cookie",
+                b"#!/usr/bin/env python\n# -*- coding: latin-1 -*-\n"
+                b"x = '\xe9'\n",
+            ),
+            ("mixed", b"import os\r\nimport sys\rx = 1\n"),
+            (
+                "mmap",
+                b"import os\r\n"
+                + b"x = '\xc3\xa9'\r\n" * (_MMAP_THRESHOLD // 10 + 1),
+            ),
+        ]
+        with tempfile.TemporaryDirectory() as tmp:
+            filename = os.path.join(tmp, "file.py")
+
+            def read(content):
+                with open(filename, "wb") as file_:
+                    file_.write(content)
+                return _read_python_source(filename)
+
+            for name, content in cases:
+                with self.subTest(name):
+                    lines, encoding, nbytes, _ = read(content)
+                    self.assertEqual((lines, encoding), decode_source(content))
+                    self.assertEqual(nbytes, len(content))
+            self.assertGreaterEqual(len(cases[-1][1]), _MMAP_THRESHOLD)
+
+            # decode_source() drops a lone CR at the very end of a file,
+            # as its newline decoder is never told the input has ended;
+            # it's now kept as the final newline, the same as LF or CRLF
+            content = b"import os\rimport sys\r"
+            lines, _, _, _ = read(content)
+            self.assertEqual(lines, ["import os", "import sys", ""])
+            self.assertEqual(decode_source(content)[0], lines[:-1])
+
+            # invalid UTF-8 raises what decode_source() raises
+            for content in [b"x = '\xff'\n", b"\n\nx = '\xff'\n"]:
+                with self.assertRaises(Exception) as expected:
+                    decode_source(content)
+                with self.assertRaises(type(expected.exception)) as raised:
+                    read(content)
+                self.assertEqual(
+                    str(raised.exception), str(expected.exception)
+                )
+
+    def test_unchanged_bounds(self):
+        from zimports.zimports import _line_diff
+        from zimports.zimports import SourceBuffer
+
+        source = SourceBuffer("import b\nimport a\n\nx = 1\ny = 2\n")
+        first = source.replace([(0, 2, ["import a", "import b"])])
+        second = first.replace([(2, 2, ["import c"])])
+        self.assertEqual(first.unchanged_bounds(source), (0, 4))
+        self.assertEqual(second.unchanged_bounds(source), (0, 4))
+        self.assertEqual(source.unchanged_bounds(source), (6, 6))
+        self.assertIsNone(source.unchanged_bounds(second))
+        self.assertIsNone(SourceBuffer(second.text).unchanged_bounds(source))
+
+        # only the lines between the bounds are compared
+        class Lines(list):
+            compared = 0
+
+            def __getitem__(self, index):
+                Lines.compared += 1
+                return super().__getitem__(index)
+
+        source = SourceBuffer("import b\nimport a\n" + "x = 1\n" * 1000)
+        rewritten = source.replace([(0, 2, ["import a", "import b"])])
+        diff = _line_diff(
+            Lines(source.lines),
+            rewritten.lines,
+            rewritten.unchanged_bounds(source),
+        )
+        self.assertEqual(diff[2], _line_diff(source.lines, rewritten.lines)[2])
+        self.assertLess(Lines.compared, 10)
+
+    def test_unified_diff(self):
+        from zimports.zimports import _unified_diff
+
+        body = "".join(f"x{i} = {i}\n" for i in range(10))
+        cases = [
+            # first and last lines
+            ("import os\n" + body, "import sys\n" + body),
+            (body + "import os\n", body + "import sys\n"),
+            ("", "import os\n"),
+            ("import os\n", ""),
+            # no newline at the end of either file, or of both
+            (body + "import os", body + "import sys\n"),
+            (body + "import os\n", body + "import sys"),
+            ("import os\n" + body + "y = 1", "import sys\n" + body + "y = 1"),
+            (body + "y = 1", body + "y = 1\n"),
+            (body + "y = 1\n", body + "y = 1"),
+            ("import os", "import sys"),
+        ]
+        with tempfile.TemporaryDirectory() as tmp:
+            filename = os.path.join(tmp, "file.py")
+            for before, after in cases:
+                with self.subTest(before=before, after=after):
+                    patch = "".join(
+                        _unified_diff(
+                            before.split("\n"),
+                            after.split("\n"),
+                            "a/file.py",
+                            "b/file.py",
+                        )
+                    )
+                    with open(filename, "w") as file_:
+                        file_.write(before)
+                    subprocess.run(
+                        ["git", "apply", "-"],
+                        input=patch.encode(),
+                        cwd=tmp,
+                        check=True,
+                    )
+                    with open(filename) as file_:
+                        self.assertEqual(file_.read(), after)
+
+            self.assertEqual(
+                list(_unified_diff(["x"], ["x"], "a/file.py", "b/file.py")),
+                [],
+            )
+
+    def test_stats_format(self):
+        with self._copy_files("empty.py", "nosort.py") as tmp:
+            _, records = self._run_records([tmp], "--check")
+
+        self.assertEqual(
+            [(r["type"], r.get("filename")) for r in records],
+            [
+                ("file", os.path.join(tmp, "empty.py")),
+                ("file", os.path.join(tmp, "nosort.py")),
+                ("summary", None),
+            ],
+        )
+        self.assertEqual(
+            [r["is_changed"] for r in records[0:2]], [False, True]
+        )
+        summary = records[2]
+        self.assertEqual(summary["files"], 2)
+        self.assertEqual(summary["changed"], 1)
+        self.assertEqual(summary["workers"], 1)
+        self.assertEqual(
+            summary["bytes_read"],
+            records[0]["bytes_read"] + records[1]["bytes_read"],
+        )
+        self.assertEqual(summary["bytes_written"], 0)
+
+    def test_timings(self):
+        _, (*files, summary) = self._run_records(
+            ["test_files/type_checking1.py", "test_files/nosort.py"],
+            "--check",
+            "--timings",
+        )
+        for record in files:
+            self.assertTrue(
+                {"read", "parse", "checker", "drill", "sort", "diff"}
+                <= set(record["timings"])
+            )
+            self.assertGreaterEqual(
+                record["counters"]["parses"],
+                record["counters"]["checker_runs"],
+            )
+            self.assertGreater(record["counters"]["drill_iterations"], 0)
+        self.assertGreater(files[0]["counters"]["type_checking_blocks"], 0)
+        self.assertEqual(
+            summary["counters"]["parses"],
+            sum(record["counters"]["parses"] for record in files),
+        )
+
+    def test_trace(self):
+        with self._copy_files("empty.py", "nosort.py") as tmp:
+            trace = os.path.join(tmp, "trace.json")
+            self._run_check(tmp, "--check", "-W", "2", "--trace", trace)
+            with open(trace) as file_:
+                events = json.load(file_)["traceEvents"]
+
+        spans = [event for event in events if event["ph"] == "X"]
+        self.assertEqual(
+            sorted(event["name"] for event in spans if event["cat"] == "file"),
+            [os.path.join(tmp, "empty.py"), os.path.join(tmp, "nosort.py")],
+        )
+        (run,) = [event for event in spans if event["cat"] == "run"]
+        self.assertEqual(run["pid"], os.getpid())
+        for file_span in spans:
+            if file_span["cat"] != "file":
+                continue
+            phases = [
+                event
+                for event in spans
+                if event["cat"] == "phase"
+                and event["pid"] == file_span["pid"]
+                and file_span["ts"]
+                <= event["ts"]
+                <= file_span["ts"] + file_span["dur"]
+            ]
+            self.assertTrue(
+                {"read", "parse", "checker"}
+                <= {event["name"] for event in phases}
+            )
+
+    def test_profile(self):
+        import pstats
+
+        with self._copy_files("empty.py", "nosort.py") as tmp:
+            profile = os.path.join(tmp, "out.pstats")
+            _, output = self._run_stderr(
+                [tmp],
+                "-W",
+                "2",
+                "--check",
+                "--profile",
+                profile,
+                "--profile-top",
+                "5",
+            )
+            stats = pstats.Stats(profile)
+
+        (rewrite,) = [
+            func
+            for func in stats.stats
+            if func[0].endswith("zimports.py") and func[2] == "rewrite"
+        ]
+        # one call for each file, from both workers
+        self.assertEqual(stats.stats[rewrite][1], 2)
+        self.assertIn("Ordered by: cumulative time", output)
+
+        # json on stderr is left as it is
+        with self._copy_files("empty.py") as tmp:
+            profile = os.path.join(tmp, "out.pstats")
+            _, output = self._run_stderr(
+                [tmp],
+                "--check",
+                "--stats-format",
+                "json",
+                "--profile",
+                profile,
+            )
+            self.assertTrue(os.path.exists(profile))
+        self.assertEqual(json.loads(output)["summary"]["files"], 1)
+
+    def test_sample(self):
+        with self._copy_files("type_checking3.py", "nosort.py") as tmp:
+            out = os.path.join(tmp, "stacks.txt")
+            self._run_check(
+                tmp, "--check", "--sample", out, "--sample-interval", "1"
+            )
+            with open(out) as file_:
+                lines = file_.read().splitlines()
+
+        self.assertTrue(lines)
+        for line in lines:
+            stack, count = line.rsplit(" ", 1)
+            self.assertGreater(int(count), 0)
+            self.assertTrue(stack.startswith("_process_file ("))
+
+    def test_memory_report(self):
+        _, (*files, summary) = self._run_records(
+            ["test_files/type_checking1.py", "test_files/nosort.py"],
+            "--check",
+            "--memory-report",
+            "--trace-malloc",
+            "--memory-top",
+            "1",
+        )
+        for record in files:
+            self.assertGreater(record["memory"]["tracemalloc_peak"], 0)
+        memory = summary["memory"]
+        (top,) = memory["top_files"]
+        self.assertEqual(
+            top["tracemalloc_peak"],
+            max(record["memory"]["tracemalloc_peak"] for record in files),
+        )
+        if files[0]["memory"]["rss_peak"] is not None:
+            self.assertEqual(
+                list(memory["worker_rss_peak"].values()),
+                [max(record["memory"]["rss_peak"] for record in files)],
+            )
+
+    def test_memory_high(self):
+        from zimports.zimports import _WorkerPool
+
+        options = mock.Mock(
+            max_tasks_per_worker=0, max_worker_rss=0, memory_high=0.85
+        )
+        pool = _WorkerPool(options, 3)
+        pool.check_interval = 0
+
+        with tempfile.TemporaryDirectory() as root:
+
+            def concurrency(current, inactive_file):
+                for name, value in [
+                    ("memory.max", "1000\n"),
+                    ("memory.current", f"{current}\n"),
+                    (
+                        "memory.stat",
+                        f"anon 1\ninactive_file {inactive_file}\n",
+                    ),
+                ]:
+                    with open(os.path.join(root, name), "w") as file_:
+                        file_.write(value)
+                return pool._concurrency()
+
+            with mock.patch("zimports.zimports._CGROUP_ROOT", root):
+                # page cache the kernel can reclaim isn't memory pressure
+                self.assertEqual(concurrency(950, 400), 3)
+                self.assertEqual(concurrency(950, 50), 2)
+                self.assertEqual(concurrency(950, 50), 1)
+                self.assertEqual(concurrency(950, 50), 1)
+                # no change between the low and high water marks
+                self.assertEqual(concurrency(800, 0), 1)
+                self.assertEqual(concurrency(700, 0), 2)
+                self.assertEqual(concurrency(950, 300), 3)
+
+                with open(os.path.join(root, "memory.max"), "w") as file_:
+                    file_.write("max\n")
+                pool.limit = 1
+                self.assertEqual(pool._concurrency(), 1)
+
+    def test_max_tasks_per_worker(self):
+        with self._copy_files(
+            "empty.py", "nosort.py", "dupe_imports.py"
+        ) as tmp:
+            trace = os.path.join(tmp, "trace.json")
+            status, output = self._run_check(
+                tmp,
+                "--list-changed",
+                "-W",
+                "2",
+                "--max-tasks-per-worker",
+                "1",
+                "--trace",
+                trace,
+            )
+            with open(trace) as file_:
+                events = json.load(file_)["traceEvents"]
+
+        self.assertEqual(status, 1)
+        self.assertEqual(
+            output.split("\n")[:-1],
+            [
+                os.path.join(tmp, "dupe_imports.py"),
+                os.path.join(tmp, "nosort.py"),
+            ],
+        )
+        # each file ran in a worker of its own
+        pids = [
+            event["pid"]
+            for event in events
+            if event["ph"] == "X" and event["cat"] == "file"
+        ]
+        self.assertEqual(len(set(pids)), 3)
+
+    def test_workers_auto(self):
+        from zimports import zimports as zimports_module
+
+        options = mock.Mock(workers="auto")
+        with mock.patch.object(
+            zimports_module, "_available_cpus", return_value=2
+        ):
+            for count, expected in [(1, 1), (3, 1), (8, 2), (100, 2)]:
+                self.assertEqual(
+                    zimports_module._worker_count(
+                        options, ["file.py"] * count
+                    ),
+                    expected,
+                )
+            self.assertEqual(
+                zimports_module._worker_count(options, ["-"] * 10), 1
+            )
+
+            # a short stream from --files-from runs serially too
+            for count, expected in [(3, 1), (100, 2)]:
+                names = [f"{i}.py" for i in range(count)]
+                streamed = zimports_module._peek_stream(iter(names))
+                self.assertEqual(
+                    zimports_module._worker_count(options, streamed), expected
+                )
+                self.assertEqual(list(streamed), names)
+
+    def test_thread_executor(self):
+        with self._copy_files(
+            "empty.py", "nosort.py", "dupe_imports.py"
+        ) as tmp:
+            status, output = self._run_check(
+                tmp, "--list-changed", "-W", "2", "--executor", "thread"
+            )
+        self.assertEqual(status, 1)
+        self.assertEqual(
+            output.split("\n")[:-1],
+            [
+                os.path.join(tmp, "dupe_imports.py"),
+                os.path.join(tmp, "nosort.py"),
+            ],
+        )
+
+    def test_fail_fast_needs_check(self):
+        with (
+            self._copy_files("nosort.py") as tmp,
+            mock.patch("argparse._sys.stderr", io.StringIO()) as stderr,
+        ):
+            with self.assertRaises(SystemExit):
+                zimports.main(
+                    [tmp, "--toml-config", "_fake.toml", "--fail-fast"]
+                )
+            self.assertIn("--fail-fast needs", stderr.getvalue())
+            with open(os.path.join(tmp, "nosort.py")) as new:
+                with open("test_files/nosort.py") as orig:
+                    self.assertEqual(new.read(), orig.read())
+
+    def test_thread_executor_profile(self):
+        for version, allowed in [((3, 11, 7), True), ((3, 12, 1), False)]:
+            with (
+                self._copy_files("empty.py") as tmp,
+                mock.patch(
+                    "zimports.cli.sys", mock.Mock(version_info=version)
+                ),
+                mock.patch("argparse._sys.stderr", io.StringIO()),
+            ):
+                argv = [tmp, "--toml-config", "_fake.toml", "--check"]
+                argv += ["--executor", "thread"]
+                argv += ["--profile", os.path.join(tmp, "out.pstats")]
+                if allowed:
+                    with mock.patch("zimports.zimports.sys"):
+                        self.assertEqual(zimports.main(argv), 0)
+                else:
+                    with self.assertRaises(SystemExit):
+                        zimports.main(argv)
+
+    def test_write_in_place(self):
+        filenames = ("nosort.py", "dupe_imports.py", "type_checking1.py")
+        for prefetch in ("0", "1", "3"):
+            with self._copy_files(*filenames) as tmp:
+                _, records = self._run_records([tmp], "--prefetch", prefetch)
+                summary = records[-1]
+                self.assertGreater(summary["bytes_written"], 0)
+                self.assertGreater(summary["cpu_time"], 0)
+
+                # nothing left for a second run to change
+                status, output = self._run_check(tmp, "--check")
+                self.assertEqual(status, 0)
+                for filename in filenames:
+                    with (
+                        open(os.path.join("test_files", filename)) as orig,
+                        open(os.path.join(tmp, filename)) as new,
+                    ):
+                        self.assertNotEqual(orig.read(), new.read())
+
+    def test_write_atomic(self):
+        for fsync in ("never", "file", "end"):
+            with self._copy_files("nosort.py", "dupe_imports.py") as tmp:
+                os.chmod(os.path.join(tmp, "nosort.py"), 0o750)
+                os.mkdir(os.path.join(tmp, "links"))
+                os.symlink(
+                    os.path.join(tmp, "dupe_imports.py"),
+                    os.path.join(tmp, "links", "link.py"),
+                )
+                os.link(
+                    os.path.join(tmp, "nosort.py"),
+                    os.path.join(tmp, "links", "hard.txt"),
+                )
+                if os.geteuid() == 0:
+                    os.chown(os.path.join(tmp, "dupe_imports.py"), 1000, 1000)
+                self._run_check(tmp, "--fsync", fsync)
+
+                self.assertEqual(
+                    sorted(os.listdir(tmp)),
+                    ["dupe_imports.py", "links", "nosort.py"],
+                )
+                self.assertEqual(
+                    sorted(os.listdir(os.path.join(tmp, "links"))),
+                    ["hard.txt", "link.py"],
+                )
+                # a hard link still shares the rewritten file
+                self.assertTrue(
+                    os.path.samefile(
+                        os.path.join(tmp, "nosort.py"),
+                        os.path.join(tmp, "links", "hard.txt"),
+                    )
+                )
+                if os.geteuid() == 0:
+                    st = os.stat(os.path.join(tmp, "dupe_imports.py"))
+                    self.assertEqual((st.st_uid, st.st_gid), (1000, 1000))
+                self.assertEqual(
+                    os.stat(os.path.join(tmp, "nosort.py")).st_mode & 0o777,
+                    0o750,
+                )
+                # the link's target was rewritten, the link left alone
+                self.assertTrue(
+                    os.path.islink(os.path.join(tmp, "links", "link.py"))
+                )
+                with (
+                    open("test_files/dupe_imports.py") as orig,
+                    open(os.path.join(tmp, "dupe_imports.py")) as new,
+                ):
+                    self.assertNotEqual(orig.read(), new.read())
+
+    def test_write_read_only_directory(self):
+        with self._copy_files("nosort.py") as tmp:
+            filename = os.path.join(tmp, "nosort.py")
+            os.chmod(tmp, 0o555)
+            try:
+                # root can create files anywhere, so that's faked
+                with mock.patch(
+                    "tempfile.mkstemp", side_effect=PermissionError
+                ):
+                    status, _ = self._run_check(filename)
+            finally:
+                os.chmod(tmp, 0o755)
+
+            self.assertEqual(status, 0)
+            self.assertEqual(os.listdir(tmp), ["nosort.py"])
+            with (
+                open("test_files/nosort.py") as orig,
+                open(filename) as new,
+            ):
+                self.assertNotEqual(orig.read(), new.read())
+
+    def test_large_file_size(self):
+        with self._copy_files("dupe_imports.py", "sqla_test_file.py") as tmp:
+            shutil.copy(
+                "test_files/dupe_imports.py", os.path.join(tmp, "full.txt")
+            )
+            zimports.main(
+                [os.path.join(tmp, "full.txt")]
+                + ["--toml-config", "_fake.toml", "-W", "1"]
+            )
+            with open(os.path.join(tmp, "dupe_imports.py"), "ab") as file_:
+                # a tail that a full rewrite would strip
+                file_.write(b"\r\n# tail  \r\n")
+
+            _, output = self._run_stderr([tmp], "--large-file-size", "0.0001")
+
+            self.assertIn(
+                "[Skipped]       %s (import header can't be isolated)"
+                % os.path.join(tmp, "sqla_test_file.py"),
+                output,
+            )
+            with (
+                open("test_files/sqla_test_file.py", "rb") as orig,
+                open(os.path.join(tmp, "sqla_test_file.py"), "rb") as new,
+            ):
+                self.assertEqual(orig.read(), new.read())
+
+            # only the header was rewritten; the tail is byte for byte
+            with (
+                open(os.path.join(tmp, "full.txt"), "rb") as full,
+                open(os.path.join(tmp, "dupe_imports.py"), "rb") as new,
+            ):
+                self.assertEqual(full.read() + b"\r\n# tail  \r\n", new.read())
+
+    def test_guards(self):
+        def run(tmp, *opts):
+            _, records = self._run_records([tmp], *opts)
+            return records[-1]["guarded"]
+
+        with self._copy_files("empty.py", "dupe_imports.py") as tmp:
+            filename = os.path.join(tmp, "dupe_imports.py")
+
+            guarded = run(tmp, "--per-file-timeout", "0.000001")
+            self.assertEqual(
+                guarded,
+                [
+                    {
+                        "filename": filename,
+                        "guard": "--per-file-timeout",
+                        "action": "skipped",
+                    },
+                    {
+                        "filename": os.path.join(tmp, "empty.py"),
+                        "guard": "--per-file-timeout",
+                        "action": "skipped",
+                    },
+                ],
+            )
+            with (
+                open("test_files/dupe_imports.py") as orig,
+                open(filename) as new,
+            ):
+                self.assertEqual(orig.read(), new.read())
+
+            # a skipped file is still echoed with --stdout
+            with self._capture_stdout() as buf:
+                zimports.main(
+                    [filename, "--toml-config", "_fake.toml", "--stdout"]
+                    + ["--per-file-timeout", "0.000001"]
+                )
+            with open(filename) as new:
+                self.assertEqual(buf.getvalue(), new.read())
+
+            # over the size, imports are sorted but none are removed
+            guarded = run(tmp, "--max-file-size", "0.0001")
+            self.assertEqual(
+                guarded,
+                [
+                    {
+                        "filename": filename,
+                        "guard": "--max-file-size",
+                        "action": "sort_only",
+                    }
+                ],
+            )
+            with open(filename) as new:
+                self.assertIn("from sqlalchemy.sql import label\n", new.read())
+
+            # sorting only doesn't run pyflakes at all
+            _, (record, _) = self._run_records(
+                ["test_files/sqla_test_file.py"],
+                "--check",
+                "--timings",
+                "--max-file-size",
+                "0.0001",
+            )
+            self.assertEqual(record["guard"], "--max-file-size")
+            self.assertGreater(record["counters"]["parses"], 0)
+            self.assertEqual(record["counters"].get("checker_runs", 0), 0)
+
+    def test_error_isolation(self):
+        for executor in ("process", "thread"):
+            with self._copy_files("dupe_imports.py", "nosort.py") as tmp:
+                with open(os.path.join(tmp, "bad.py"), "w") as file_:
+                    file_.write("import os\ndef f(:\n")
+
+                status, records = self._run_records(
+                    [tmp], "-W", "2", "--executor", executor
+                )
+                self.assertEqual(status, 2)
+
+                self.assertEqual(
+                    [r.get("error") for r in records[:-1]],
+                    [
+                        {
+                            "type": "SyntaxError",
+                            "message": "invalid syntax (bad.py, line 2)",
+                        },
+                        None,
+                        None,
+                    ],
+                )
+                self.assertEqual(records[-1]["errors"], 1)
+
+                # the other files were still rewritten
+                for name in ("dupe_imports.py", "nosort.py"):
+                    with (
+                        open(f"test_files/{name}") as orig,
+                        open(os.path.join(tmp, name)) as new,
+                    ):
+                        self.assertNotEqual(orig.read(), new.read())
+
+    def test_skip_markers(self):
+        with self._copy_files("dupe_imports.py") as tmp:
+            with open("test_files/dupe_imports.py") as file_:
+                source = file_.read()
+            for name, header in [
+                ("skip.py", "# zimports: skip-file\n"),
+                ("generated.py", '"""@generated by a tool."""\n'),
+                ("late.py", "#\n" * 4096 + "# @generated\n"),
+            ]:
+                with open(os.path.join(tmp, name), "w") as file_:
+                    file_.write(header + source)
+
+            _, output = self._run_stderr(
+                [tmp], "--generated-marker", "@generated", "--check"
+            )
+            lines = output.splitlines()
+            self.assertEqual(
+                lines,
+                [
+                    mock.ANY,
+                    "[Skipped]       %s (found '@generated')"
+                    % os.path.join(tmp, "generated.py"),
+                    # only the start of the file is looked at
+                    mock.ANY,
+                    "[Skipped]       %s (found '# zimports: skip-file')"
+                    % os.path.join(tmp, "skip.py"),
+                ],
+            )
+            self.assertTrue(lines[0].startswith("[Generating]"))
+            self.assertTrue(lines[2].startswith("[Generating]"))
+
+            # a skipped file is echoed as it is, from a file or stdin
+            with open(os.path.join(tmp, "skip.py"), "rb") as file_:
+                content = file_.read()
+            for path in (os.path.join(tmp, "skip.py"), "-"):
+                buf = io.StringIO()
+                fake_sys = mock.Mock(
+                    stdout=buf, stdin=mock.Mock(buffer=io.BytesIO(content))
+                )
+                with mock.patch("zimports.zimports.sys", fake_sys):
+                    zimports.main(
+                        [path, "--toml-config", "_fake.toml", "--stdout"]
+                    )
+                self.assertEqual(buf.getvalue(), content.decode("utf-8"))
+
+
+class StartupTest(unittest.TestCase):
+    """Check what's imported on startup, using ``python -X importtime``."""
+
+    def _imported_modules(self, *args):
+        proc = subprocess.run(
+            [sys.executable, "-X", "importtime", *args],
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.PIPE,
+            text=True,
+            check=True,
+        )
+        return {
+            line.rsplit("|", 1)[1].strip()
+            for line in proc.stderr.splitlines()
+            if line.startswith("import time:") and "|" in line
+        }
+
+    def test_import_package(self):
+        modules = self._imported_modules("-c", "import zimports")
+        for name in (
+            "zimports.zimports",
+            "pyflakes.checker",
+            "difflib",
+            "multiprocessing",
+            "importlib.metadata",
+            "tomli",
+        ):
+            self.assertNotIn(name, modules)
+
+    def test_unchanged_single_file(self):
+        modules = self._imported_modules(
+            "-m",
+            "zimports",
+            "--toml-config",
+            "_fake.toml",
+            "--stdout",
+            "test_files/empty.py",
+        )
+        self.assertIn("pyflakes.checker", modules)
+        # older pyflakes import difflib themselves, by way of doctest
+        if "difflib" not in self._imported_modules(
+            "-c", "import pyflakes.checker"
+        ):
+            self.assertNotIn("difflib", modules)
+        self.assertNotIn("multiprocessing", modules)
+        self.assertNotIn("tomli", modules)
+
+    def test_changed_single_file(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            shutil.copy("test_files/nosort.py", tmp)
+            modules = self._imported_modules(
+                "-m",
+                "zimports",
+                "--toml-config",
+                "_fake.toml",
+                os.path.join(tmp, "nosort.py"),
+            )
+        # read and written without starting any threads
+        self.assertNotIn("concurrent.futures", modules)
+        self.assertNotIn("logging", modules)
+
 
 sqlalchemy_names = [
     "alias",
@@ -1,11 +1,9 @@
 import argparse
 import configparser
 import os
-
-import tomli
+import sys
 
 from .vendored.flake8 import parse_files_to_codes_mapping
-from .zimports import run_with_options
 
 
 def _load_config(config_file="setup.cfg"):
@@ -22,6 +20,8 @@ def _load_config(config_file="setup.cfg"):
 def _load_toml(config_file="pyproject.toml"):
 
     if os.path.exists(config_file):
+        import tomli
+
         with open(config_file, "rb") as f:
             toml_dict = tomli.load(f)  # type: ignore
     else:
@@ -30,6 +30,20 @@ def _load_toml(config_file="pyproject.toml"):
     return toml_dict.get("tool", {}).get("zimports", {})
 
 
+def _workers(value):
+    if value == "auto":
+        return value
+    try:
+        workers = int(value)
+    except ValueError:
+        workers = 0
+    if workers < 1:
+        raise argparse.ArgumentTypeError(
+            f"expected 'auto' or a number >= 1, got {value!r}"
+        )
+    return workers
+
+
 def main(argv=None):
     parser = argparse.ArgumentParser(prog="zimports")
 
@@ -106,6 +120,15 @@ def main(argv=None):
         "less than <HEURISTIC_UNUSED> percent of the total lines of code. "
         "Ignored in type checking blocks",
     )
+    parser.add_argument(
+        "--generated-marker",
+        action="append",
+        dest="generated_markers",
+        metavar="TEXT",
+        help="leave files alone that have TEXT in their first 4 KB, e.g. "
+        "'@generated'; may be given more than once.  Files with a "
+        "'# zimports: skip-file' comment are always left alone",
+    )
     parser.add_argument(
         "--statsonly",
         action="store_true",
@@ -128,19 +151,304 @@ def main(argv=None):
         "--stdout", action="store_true", help="dump file output to stdout"
     )
     parser.add_argument(
-        "filename", nargs="+", help="Python filename(s) or directories"
+        "--stats-format",
+        choices=["text", "json", "ndjson"],
+        default="text",
+        help="format of the per-file stats written to stderr; json and "
+        "ndjson also write a summary of the whole run [default: text]",
+    )
+    parser.add_argument(
+        "--timings",
+        action="store_true",
+        help="record the time spent in each phase of processing, along "
+        "with counts of parses, checker runs and similar, for each file "
+        "and for the whole run",
+    )
+    parser.add_argument(
+        "--trace",
+        type=str,
+        metavar="FILE",
+        help="write a Chrome / Perfetto trace-event JSON file to FILE, with "
+        "a span for each file and each phase of processing it, for every "
+        "worker process",
+    )
+    parser.add_argument(
+        "--profile",
+        type=str,
+        metavar="FILE",
+        help="run each file under cProfile in its worker, and write the "
+        "combined stats for all files to FILE in pstats format",
+    )
+    parser.add_argument(
+        "--profile-top",
+        type=int,
+        default=25,
+        metavar="N",
+        help="with --profile, print the top N functions by cumulative "
+        "time to stderr, with --stats-format text; 0 to print nothing "
+        "[default: 25]",
+    )
+    parser.add_argument(
+        "--sample",
+        type=str,
+        metavar="FILE",
+        help="sample the stack of each worker while it processes files, "
+        "and write the counts of each stack seen to FILE in the collapsed "
+        "format read by flamegraph tools",
+    )
+    parser.add_argument(
+        "--sample-interval",
+        type=float,
+        default=10.0,
+        metavar="MS",
+        help="with --sample, milliseconds of CPU time between samples "
+        "[default: 10]",
+    )
+    parser.add_argument(
+        "--memory-report",
+        action="store_true",
+        help="record the peak RSS of each worker, and how much each file "
+        "raised it by; report the workers and the most memory hungry "
+        "files at the end, and include memory in --stats-format records",
+    )
+    parser.add_argument(
+        "--trace-malloc",
+        action="store_true",
+        help="with --memory-report, also record the peak memory allocated "
+        "for each file using tracemalloc, and rank files by it; this "
+        "slows processing down considerably",
+    )
+    parser.add_argument(
+        "--memory-top",
+        type=int,
+        default=10,
+        metavar="N",
+        help="with --memory-report, the number of files to report "
+        "[default: 10]",
+    )
+    parser.add_argument(
+        "--patch",
+        type=str,
+        metavar="FILE",
+        help="don't modify files, write a combined patch of all changes "
+        "to FILE, which can be applied with 'git apply'",
+    )
+    parser.add_argument(
+        "--output-order",
+        choices=["path", "completed"],
+        default="path",
+        help="write output for each file in the order the paths were "
+        "given / found, or as soon as each file completes "
+        "[default: path]",
+    )
+    parser.add_argument(
+        "--check",
+        action="store_true",
+        help="don't write anything, just exit with status 1 if any file "
+        "would be changed",
+    )
+    parser.add_argument(
+        "--fail-fast",
+        action="store_true",
+        help="stop at the first file that would be changed, cancelling "
+        "outstanding work; only with --check, --list-changed, --diff, "
+        "--patch, --stdout or --statsonly, as files aren't written",
+    )
+    parser.add_argument(
+        "-l",
+        "--list-changed",
+        action="store_true",
+        help="print only the paths of files that would be changed; "
+        "implies --check",
+    )
+    parser.add_argument(
+        "-0",
+        "--null",
+        action="store_true",
+        help="separate paths read by --files-from and printed by "
+        "--list-changed with NUL instead of newline",
+    )
+    parser.add_argument(
+        "--files-from",
+        type=str,
+        metavar="PATH",
+        help="also run the files and directories listed in PATH, or in "
+        "stdin for '-', one per line; files are run as the list is read",
+    )
+    parser.add_argument(
+        "--checkpoint",
+        type=str,
+        metavar="FILE",
+        help="record each file that's been run, along with a digest of its "
+        "content, in FILE as the run goes, so that it can be resumed with "
+        "--resume if it's interrupted",
+    )
+    parser.add_argument(
+        "--resume",
+        action="store_true",
+        help="with --checkpoint, skip the files recorded in the checkpoint "
+        "whose content hasn't changed since, and carry on recording to it; "
+        "a checkpoint written with different options that change what's "
+        "done with files, or by another version, isn't resumed from: the "
+        "run stops with an error and leaves the checkpoint as it was",
+    )
+    parser.add_argument(
+        "--checkpoint-interval",
+        type=float,
+        default=5.0,
+        metavar="SECONDS",
+        help="with --checkpoint, how often to write the files that have "
+        "been run to the checkpoint [default: 5]",
+    )
+    parser.add_argument(
+        "--time-budget",
+        type=float,
+        default=0,
+        metavar="SECONDS",
+        help="stop starting new files after this many seconds, running "
+        "first those modified since the last git commit, then those with "
+        "uncommitted changes, then the rest, most recently modified first; "
+        "combine with --checkpoint to carry on later with --resume "
+        "[default: no budget]",
+    )
+    parser.add_argument(
+        "--prefetch",
+        type=int,
+        default=2,
+        metavar="K",
+        help="read and decode up to K files ahead of the one being "
+        "rewritten, on a pool of K threads in each worker; 0 to read "
+        "each file only when it's needed [default: 2]",
+    )
+    parser.add_argument(
+        "--fsync",
+        choices=["never", "file", "end"],
+        default="never",
+        help="when to fsync rewritten files: as each one is written, "
+        "after each batch of files a worker runs, or never  "
+        "[default: never]",
+    )
+    parser.add_argument(
+        "--large-file-size",
+        type=float,
+        default=0,
+        metavar="MIB",
+        help="for files of MIB megabytes or more, rewrite only the "
+        "import header in place and copy the rest of the file over "
+        "unchanged; such files whose changes aren't confined to the "
+        "imports at the top of the file are skipped; 0 to rewrite "
+        "every file in full [default: 0]",
+    )
+    parser.add_argument(
+        "--max-file-size",
+        type=float,
+        default=0,
+        metavar="MIB",
+        help="only sort the imports of files larger than MIB megabytes, "
+        "keeping unused imports and star imports as they are; 0 for no "
+        "limit [default: 0]",
+    )
+    parser.add_argument(
+        "--per-file-timeout",
+        type=float,
+        default=0,
+        metavar="SECONDS",
+        help="if rewriting a file takes longer than SECONDS, try it again "
+        "only sorting its imports, and skip it if that takes too long "
+        "as well; checked between the stages of the rewrite, so a stage "
+        "can overrun it; 0 for no limit [default: 0]",
+    )
+    parser.add_argument(
+        "--executor",
+        choices=["process", "thread", "interpreter"],
+        default="process",
+        help="run files in worker processes, in threads (which run in "
+        "parallel on free-threaded builds of Python), or in "
+        "subinterpreters (Python 3.14+)  [default: process]",
+    )
+    parser.add_argument(
+        "--max-tasks-per-worker",
+        type=int,
+        default=0,
+        metavar="N",
+        help="with the process executor, replace each worker process "
+        "once it has run N files, "
+        "releasing modules imported by --expand-stars; 0 for no limit "
+        "[default: 0]",
+    )
+    parser.add_argument(
+        "--max-worker-rss",
+        type=float,
+        default=0,
+        metavar="MIB",
+        help="with the process executor, replace a worker process once "
+        "its peak RSS passes MIB "
+        "megabytes; 0 for no limit [default: 0]",
+    )
+    parser.add_argument(
+        "--memory-high",
+        type=float,
+        default=0.85,
+        metavar="FRACTION",
+        help="with the process executor, when the memory usage of the "
+        "cgroup zimports runs in passes "
+        "this fraction of its limit, run fewer files at once until it "
+        "drops; 0 to disable [default: 0.85]",
+    )
+    parser.add_argument(
+        "filename", nargs="*", help="Python filename(s) or directories"
     )
-    cpu = os.cpu_count()
     parser.add_argument(
         "-W",
         "--workers",
-        type=int,
-        default=cpu,
-        help=f"Number of parallel workers  [default: {cpu};x>=1]",
+        type=_workers,
+        default="auto",
+        help="Number of parallel workers, or 'auto' to size to the CPUs "
+        "available to this process and the number of files  "
+        "[default: auto;x>=1]",
     )
 
     options = parser.parse_args(argv)
 
+    if not options.filename and not options.files_from:
+        parser.error("give filenames or directories, or --files-from")
+    if options.resume and not options.checkpoint:
+        parser.error("--resume needs --checkpoint")
+    if options.executor != "process":
+        if options.sample or options.trace_malloc:
+            parser.error(
+                "--sample and --trace-malloc need the process executor"
+            )
+    if (
+        options.executor == "thread"
+        and options.profile
+        and sys.version_info >= (3, 12)
+    ):
+        # cProfile takes the one profiler slot of sys.monitoring, which
+        # all threads share
+        parser.error(
+            "--profile needs the process or interpreter executor "
+            "on Python 3.12 or later"
+        )
+    if options.executor == "interpreter" and sys.version_info < (3, 14):
+        parser.error("the interpreter executor needs Python 3.14 or later")
+
+    if options.list_changed:
+        options.check = True
+    if options.fail_fast and not (
+        options.check
+        or options.diff
+        or options.patch
+        or options.stdout
+        or options.statsonly
+    ):
+        # stopping cancels files in progress, which could be partway
+        # through being written
+        parser.error(
+            "--fail-fast needs a mode that leaves files alone: --check, "
+            "--list-changed, --diff, --patch, --stdout or --statsonly"
+        )
+
     toml = _load_toml(options.toml_config)
     if options.black_line_length is NOT_SET:
         options.black_line_length = toml.get("black-line-length", None)
@@ -154,6 +462,15 @@ def main(argv=None):
         )
     if options.heuristic_unused is NOT_SET:
         options.heuristic_unused = toml.get("heuristic-unused", None)
+    if options.keep_unused:
+        if options.heuristic_unused:
+            raise Exception(
+                "keep-unused and heuristic-unused are mutually exclusive"
+            )
+        options.heuristic_unused = 0
+        options.keep_unused_type_checking = True
+    if options.generated_markers is None:
+        options.generated_markers = toml.get("generated-markers", [])
 
     if "per-file-ignores" in config["flake8"]:
         options.per_file_ignores = parse_files_to_codes_mapping(
@@ -162,4 +479,8 @@ def main(argv=None):
     else:
         options.per_file_ignores = []
 
-    run_with_options(options)
+    # deferred so that argument errors and --help don't pay for the
+    # import of the rewriter and its dependencies
+    from .zimports import run_with_options
+
+    return run_with_options(options)
@@ -1,12 +1,12 @@
 import sys
 
-if sys.version_info >= (3, 10):
-    import importlib.metadata as importlib_metadata
-else:
-    import importlib_metadata
-
 
 def lookup_entry_point(name):
+    if sys.version_info >= (3, 10):
+        import importlib.metadata as importlib_metadata
+    else:
+        import importlib_metadata
+
     try:
         (ep,) = importlib_metadata.entry_points(
             name=name, group="flake8_import_order.styles"
@@ -1,31 +1,47 @@
+from array import array
 import ast
 from ast import parse
 import codecs
 from collections.abc import Iterable
 from collections.abc import Iterator
+from collections.abc import Sequence
+import contextlib
 import dataclasses as dc
-import difflib
 import enum
-from functools import partial
+from functools import lru_cache
 import importlib
+import importlib.util
 import io
-from multiprocessing import Pool
+from itertools import accumulate
+from itertools import chain
+from itertools import islice
+from itertools import tee
 import os
 import re
+import shutil
+import stat
 import sys
 import time
 from typing import Any
-from typing import NamedTuple
 from typing import Optional
+from typing import TYPE_CHECKING
 
 import flake8_import_order as f8io
-import pyflakes.checker
-import pyflakes.messages
 
 from .vendored.flake8 import matches_filename
 from .vendored.flake8 import normalize_path
 from .vendored.flake8_import_order import lookup_entry_point
 
+if TYPE_CHECKING:
+    import pyflakes.checker
+
+
+@lru_cache()
+def _load_style(name: str) -> Any:
+    # looking up an entry point scans the metadata of every installed
+    # distribution, so do it once per process rather than once per file
+    return lookup_entry_point(name).load()
+
 
 class RewritePass(enum.Enum):
     PLAIN = 0
@@ -33,17 +49,247 @@ class RewritePass(enum.Enum):
     ANTI_TYPE_CHECK = 2
 
 
+class SourceBuffer:
+    """Python source text, indexed by line.
+
+    A buffer is immutable; :meth:`.replace` returns a new buffer that
+    holds a pending list of line range replacements against this one.
+    The new text is assembled from slices of this buffer's text only
+    when it's first needed, e.g. to be parsed or written out.
+
+    Indexing and iteration give lines without the newline, the same
+    as ``text.split("\\n")``.
+
+    A buffer made by :meth:`.replace` remembers the buffer its chain of
+    replacements started from, and how many lines at its start and end
+    haven't been touched since, see :meth:`.unchanged_bounds`.
+
+    """
+
+    __slots__ = ("_text", "_lines", "_offsets", "_base", "_edits", "_origin")
+
+    def __init__(
+        self,
+        text: Optional[str] = None,
+        base: Optional["SourceBuffer"] = None,
+        edits: Sequence[tuple[int, int, Sequence[str]]] = (),
+    ):
+        self._text = text
+        self._lines: Optional[list[str]] = None
+        self._offsets: Optional[list[int]] = None
+        self._base = base
+        self._edits = edits
+        self._origin: Optional[tuple["SourceBuffer", int, int]] = None
+
+    @classmethod
+    def from_lines(cls, lines: Iterable[str]) -> "SourceBuffer":
+        lines = list(lines)
+        buffer = cls("\n".join(lines))
+        buffer._lines = lines
+        return buffer
+
+    @property
+    def text(self) -> str:
+        if self._text is None:
+            self._text = self._base._apply(self._edits)
+            self._base = self._edits = None
+        return self._text
+
+    @property
+    def lines(self) -> list[str]:
+        if self._lines is None:
+            self._lines = self.text.split("\n")
+        return self._lines
+
+    @property
+    def offsets(self) -> list[int]:
+        """Character offset where each line starts, followed by
+        ``len(text) + 1``, i.e. where a line after the last one would
+        start."""
+        if self._offsets is None:
+            self._offsets = [
+                0,
+                *accumulate(len(line) + 1 for line in self.lines),
+            ]
+        return self._offsets
+
+    def __len__(self) -> int:
+        return len(self.lines)
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self.lines)
+
+    def __getitem__(self, index):
+        return self.lines[index]
+
+    def replace(
+        self, edits: Iterable[tuple[int, int, Sequence[str]]]
+    ) -> "SourceBuffer":
+        """Return a new buffer with line ranges replaced.
+
+        ``edits`` is a collection of ``(start, end, lines)``, where
+        ``start`` and ``end`` are zero-based, half-open line indexes into
+        this buffer.  ``start == end`` inserts ``lines`` before ``start``.
+        Ranges may not overlap; an insert at the same index as a replaced
+        range goes before it.
+
+        """
+        edits = sorted(edits, key=lambda edit: edit[0:2])
+        if not edits:
+            return self
+        buffer = SourceBuffer(base=self, edits=edits)
+        origin, prefix, suffix = self._origin or (self, len(self), len(self))
+        buffer._origin = (
+            origin,
+            min(prefix, edits[0][0]),
+            min(suffix, len(self) - max(end for _, end, _ in edits)),
+        )
+        return buffer
+
+    def unchanged_bounds(
+        self, origin: "SourceBuffer"
+    ) -> Optional[tuple[int, int]]:
+        """Return how many lines at the start and at the end of this buffer
+        are known to be the same as those of ``origin``, if this buffer was
+        made from it by :meth:`.replace`, or None.  The lines inside these
+        bounds were replaced, though possibly with the same lines."""
+        if self is origin:
+            return len(self), len(self)
+        if self._origin is None or self._origin[0] is not origin:
+            return None
+        return self._origin[1], self._origin[2]
+
+    def _apply(self, edits: Sequence[tuple[int, int, Sequence[str]]]) -> str:
+        text = self.text
+        offsets = self.offsets
+        pieces: list[str] = []
+        pos = 0
+        for start, end, lines in edits:
+            assert start >= pos, "overlapping edits"
+            if start > pos:
+                # unchanged lines pos..start - 1, without the last newline
+                pieces.append(text[offsets[pos] : offsets[start] - 1])
+            pieces.extend(lines)
+            pos = end
+        if pos < len(offsets) - 1:
+            pieces.append(text[offsets[pos] :])
+        return "\n".join(pieces)
+
+
+class _Phase:
+    __slots__ = ("timers", "name")
+
+    def __init__(self, timers: "PhaseTimers", name: str):
+        self.timers = timers
+        self.name = name
+
+    def __enter__(self):
+        self.timers._enter(self.name)
+
+    def __exit__(self, *exc_info):
+        self.timers._exit()
+
+
+class _NullPhase:
+    __slots__ = ()
+
+    def __enter__(self):
+        pass
+
+    def __exit__(self, *exc_info):
+        pass
+
+
+_NULL_PHASE = _NullPhase()
+
+
+class PhaseTimers:
+    """Time spent in each phase of processing a file, along with counts of
+    units of work done.
+
+    Phases nest; time spent in an inner phase isn't counted towards the
+    phase that encloses it, so that the times for all phases add up.
+
+    With ``trace=True``, each phase is also recorded in :attr:`.events`
+    as a ``(name, start, end)`` span, for ``--trace``.
+
+    """
+
+    def __init__(self, trace: bool = False):
+        self.times: dict[str, float] = {}
+        self.counts: dict[str, int] = {}
+        self.events: Optional[list[tuple[str, float, float]]] = (
+            [] if trace else None
+        )
+        self._stack: list[tuple[str, float]] = []
+        self._mark = 0.0
+
+    def phase(self, name: str) -> Any:
+        return _Phase(self, name)
+
+    def count(self, name: str, amount: int = 1) -> None:
+        self.counts[name] = self.counts.get(name, 0) + amount
+
+    def _add_time(self, name: str, now: float) -> None:
+        self.times[name] = self.times.get(name, 0.0) + now - self._mark
+        self._mark = now
+
+    def _enter(self, name: str) -> None:
+        now = time.perf_counter()
+        if self._stack:
+            self._add_time(self._stack[-1][0], now)
+        else:
+            self._mark = now
+        self._stack.append((name, now))
+
+    def _exit(self) -> None:
+        now = time.perf_counter()
+        name, start = self._stack.pop()
+        self._add_time(name, now)
+        if self.events is not None:
+            self.events.append((name, start, now))
+
+
+class _NullTimers(PhaseTimers):
+    """Stands in for :class:`.PhaseTimers` when timings weren't asked
+    for, doing nothing."""
+
+    def phase(self, name: str) -> Any:
+        return _NULL_PHASE
+
+    def count(self, name: str, amount: int = 1) -> None:
+        pass
+
+
+NULL_TIMERS = _NullTimers()
+
+
+def _check_deadline(deadline: Optional[float]) -> None:
+    """Raise :class:`TimeoutError` if ``time.perf_counter()`` has passed
+    ``deadline``."""
+    if deadline is not None and time.perf_counter() > deadline:
+        raise TimeoutError()
+
+
 @dc.dataclass
 class Rewriter:
     options: Any
     filename: str
-    source_lines: list[str]
+    source: SourceBuffer
+    timers: PhaseTimers = NULL_TIMERS
+    # only sort the imports, without looking for unused ones to remove or
+    # expanding star imports
+    sort_only: bool = False
+    # a time.perf_counter() time after which TimeoutError is raised,
+    # checked between the stages of the rewrite
+    deadline: Optional[float] = None
 
     def __post_init__(self):
         self.keep_threshhold: float = self.options.heuristic_unused
-        self.expand_stars: bool = self.options.expand_stars
-        style_entry_point = lookup_entry_point(self.options.style)
-        self.style = style_entry_point.load()
+        self.expand_stars: bool = (
+            self.options.expand_stars and not self.sort_only
+        )
+        self.style = _load_style(self.options.style)
 
         self.stats = {
             "starttime": time.time(),
@@ -52,25 +298,27 @@ class Rewriter:
             "removed_imports": 0,
         }
 
-    def _do_rewrite(
-        self, source_lines: list[str], type_check_pass: RewritePass
-    ):
+    def _do_rewrite(self, source: SourceBuffer, type_check_pass: RewritePass):
+        _check_deadline(self.deadline)
         if type_check_pass in (
             RewritePass.TYPE_CHECK,
             RewritePass.ANTI_TYPE_CHECK,
         ):
             # Stats are collected only on the non type check pass.
             stats = self.stats.copy()
-            type_checking_blocks = TypeCheckingBlocks(
-                source_lines, type_check_pass
-            )
+            type_checking_blocks = TypeCheckingBlocks(source, type_check_pass)
+            self.timers.count("type_checking_blocks")
         else:
             stats = self.stats
             type_checking_blocks = None
         # parse the code.  get the imports and a collection of line numbers
         # we definitely don't want to discard
         imports, _, lines_with_code = _parse_toplevel_imports(
-            self.options, self.filename, source_lines, type_checking_blocks
+            self.options,
+            self.filename,
+            source,
+            type_checking_blocks,
+            timers=self.timers,
         )
 
         original_imports = len(imports)
@@ -84,49 +332,63 @@ class Rewriter:
         # extra lines they take up which we figure out by looking at the
         # "gap" between statements
         import_gap_lines: set[int] = _get_import_discard_lines(
-            source_lines, imports, lines_with_code
+            source, imports, lines_with_code
         )
 
         # flatten imports into single import per line and rewrite
         # full source
-        if not self.options.multi_imports:
-            imports = list(
-                _dedupe_single_imports(
+        if not self.options.multi_imports and imports:
+            table = imports[0].table
+            imports = [
+                table.single(name_row)
+                for name_row in _dedupe_single_imports(
+                    table,
                     _as_single_imports(
-                        imports, stats, expand_stars=self.expand_stars
+                        imports,
+                        stats,
+                        expand_stars=self.expand_stars,
+                        timers=self.timers,
                     ),
                     stats,
                 )
+            ]
+        with self.timers.phase("write_source"):
+            on_source = _write_source(
+                source,
+                imports,
+                [],
+                import_gap_lines,
+                imports_start_on,
+                self.style,
             )
-        on_source_lines = _write_source(
-            source_lines,
-            imports,
-            [],
-            import_gap_lines,
-            imports_start_on,
-            self.style,
-        )
         if type_check_pass is not RewritePass.PLAIN:
-            TypeCheckingBlocks(
-                on_source_lines, type_check_pass
-            ).remove_empty_blocks(on_source_lines)
+            on_source = TypeCheckingBlocks(
+                on_source, type_check_pass
+            ).remove_empty_blocks(on_source)
             type_checking_blocks = TypeCheckingBlocks(
-                on_source_lines, type_check_pass
+                on_source, type_check_pass
             )
+            self.timers.count("type_checking_blocks", 2)
         # now parse again.  Because pyflakes won't tell us about unused
         # imports that are not the first import, we had to flatten first.
         imports, warnings, lines_with_code = _parse_toplevel_imports(
             self.options,
             self.filename,
-            on_source_lines,
+            on_source,
             type_checking_blocks,
-            drill_for_warnings=True,
+            drill_for_warnings=not self.sort_only,
+            timers=self.timers,
+            deadline=self.deadline,
         )
+        _check_deadline(self.deadline)
 
         if type_check_pass is not RewritePass.PLAIN:
             # now remove unused names from the imports if keep unused was not
             # specified in the arguments
-            if self.options.keep_unused_type_checking is False:
+            if (
+                self.options.keep_unused_type_checking is False
+                and not self.sort_only
+            ):
                 _remove_unused_names(imports, warnings, stats)
         else:
             # now remove unused names from the imports
@@ -145,7 +407,7 @@ class Rewriter:
                     / float(len(lines_with_code))
                 ) * 100
 
-            if (
+            if not self.sort_only and (
                 self.keep_threshhold is None
                 or import_proportion < self.keep_threshhold
             ):
@@ -153,28 +415,31 @@ class Rewriter:
 
         stats["import_line_delta"] = len(imports) - original_imports
 
-        sorted_imports, nosort_imports = sort_imports(
-            self.style, imports, self.options
-        )
+        with self.timers.phase("sort"):
+            sorted_imports, nosort_imports = sort_imports(
+                self.style, imports, self.options
+            )
 
-        rewritten = _write_source(
-            source_lines,
-            sorted_imports,
-            nosort_imports,
-            import_gap_lines,
-            imports_start_on,
-            self.style,
-        )
-        if type_check_pass is not RewritePass.PLAIN:
-            TypeCheckingBlocks(rewritten, type_check_pass).remove_empty_blocks(
-                rewritten
+        with self.timers.phase("write_source"):
+            rewritten = _write_source(
+                source,
+                sorted_imports,
+                nosort_imports,
+                import_gap_lines,
+                imports_start_on,
+                self.style,
             )
+        if type_check_pass is not RewritePass.PLAIN:
+            rewritten = TypeCheckingBlocks(
+                rewritten, type_check_pass
+            ).remove_empty_blocks(rewritten)
+            self.timers.count("type_checking_blocks")
         return rewritten
 
     def rewrite(self):
         # pass for each distinct block we want to write
         rewritten = self._do_rewrite(
-            self.source_lines,
+            self.source,
             type_check_pass=RewritePass.TYPE_CHECK,
         )
         rewritten = self._do_rewrite(
@@ -186,14 +451,25 @@ class Rewriter:
         )
 
         if self.options.black_line_length:
-            rewritten = list(
-                _mini_black_format(rewritten, self.options.black_line_length)
-            )
+            with self.timers.phase("black"):
+                rewritten = _mini_black_format(
+                    rewritten, self.options.black_line_length
+                )
 
-        differ = list(difflib.Differ().compare(self.source_lines, rewritten))
+        added = removed = 0
+        with self.timers.phase("diff"):
+            self.diff = _line_diff(
+                self.source.lines,
+                rewritten.lines,
+                rewritten.unchanged_bounds(self.source),
+            )
+            for tag, i1, i2, j1, j2 in self.diff[2]:
+                if tag != "equal":
+                    removed += i2 - i1
+                    added += j2 - j1
 
-        self.stats["added"] = len([l for l in differ if l.startswith("+ ")])
-        self.stats["removed"] = len([l for l in differ if l.startswith("- ")])
+        self.stats["added"] = added
+        self.stats["removed"] = removed
         self.stats["is_changed"] = bool(
             self.stats["added"] or self.stats["removed"]
         )
@@ -202,7 +478,7 @@ class Rewriter:
 
 
 class TypeCheckingBlocks:
-    def __init__(self, source_lines, type_):
+    def __init__(self, source: SourceBuffer, type_):
         self.type_checking_blocks = []
         self.anti_type_checking_blocks = []
         self.type = type_
@@ -210,7 +486,7 @@ class TypeCheckingBlocks:
         in_type_checking_block = False
         in_anti_type_checking_block = False
 
-        for lineno, line in enumerate(source_lines, 1):
+        for lineno, line in enumerate(source, 1):
             if re.match(r"^if [\w+\.]*TYPE_CHECKING:", line):
                 # we are inside an "if TYPE_CHECKING:" block
                 in_type_checking_block = True
@@ -246,39 +522,44 @@ class TypeCheckingBlocks:
         else:
             assert False
 
-    def remove_empty_blocks(self, source_lines):
+    def remove_empty_blocks(self, source: SourceBuffer) -> SourceBuffer:
+        edits: set[tuple[int, int, tuple[str, ...]]] = set()
+
         if self.type is RewritePass.TYPE_CHECK:
             removed_type_check = set()
             for block, lines, _ in self.type_checking_blocks:
-                if all(not source_lines[line - 1] for line in lines):
+                if all(not source[line - 1] for line in lines):
                     removed_type_check.add(block)
-                    source_lines[block - 1] = ""
+                    edits.add((block - 1, block, ("",)))
 
             if self.anti_type_checking_blocks:
                 for block, lines, typcheck in self.anti_type_checking_blocks:
                     if typcheck in removed_type_check:
-                        source_lines[block - 1 : block - 1] = [
-                            "if TYPE_CHECKING:",
-                            "    pass",
-                        ]
+                        edits.add(
+                            (
+                                block - 1,
+                                block - 1,
+                                ("if TYPE_CHECKING:", "    pass"),
+                            )
+                        )
 
         elif self.type is RewritePass.ANTI_TYPE_CHECK:
             for block, lines, typcheck_line in self.anti_type_checking_blocks:
-                if all(not source_lines[line - 1] for line in lines):
-                    source_lines[block - 1] = ""
-                    if source_lines[typcheck_line - 1 : typcheck_line + 1] == [
+                if all(not source[line - 1] for line in lines):
+                    edits.add((block - 1, block, ("",)))
+                    if source[typcheck_line - 1 : typcheck_line + 1] == [
                         "if TYPE_CHECKING:",
                         "    pass",
                     ]:
-                        source_lines[typcheck_line - 1 : typcheck_line + 1] = (
-                            []
-                        )
+                        edits.add((typcheck_line - 1, typcheck_line + 1, ()))
         else:
             assert False
 
+        return source.replace(edits)
+
 
 def _get_import_discard_lines(
-    source_lines: list[str],
+    source: SourceBuffer,
     imports: list["ClassifiedImport"],
     lines_with_code: set[str],
 ):
@@ -289,16 +570,14 @@ def _get_import_discard_lines(
     intermediary_whitespace_lines = []
 
     prev = None
-    for lineno in [node.lineno for node in imports] + [len(source_lines) + 1]:
+    for lineno in [node.lineno for node in imports] + [len(source) + 1]:
         if prev is not None:
             for gap in range(prev + 1, lineno):
                 if gap in lines_with_code:
                     # a codeline is here, so we definitely
                     # are not in an import anymore, go to the next one
                     break
-                elif not _is_whitespace_or_comment_or_else(
-                    source_lines[gap - 1]
-                ):
+                elif not _is_whitespace_or_comment_or_else(source[gap - 1]):
                     import_gap_lines.add(gap)
         prev = lineno
 
@@ -307,7 +586,7 @@ def _get_import_discard_lines(
     sorted_gap_lines = list(sorted(import_gap_lines))
     for index, gap_line in enumerate(sorted_gap_lines[0:-1]):
         for lineno in range(gap_line + 1, sorted_gap_lines[index + 1]):
-            if not source_lines[lineno - 1].rstrip():
+            if not source[lineno - 1].rstrip():
                 intermediary_whitespace_lines.append(lineno)
             else:
                 intermediary_whitespace_lines[:] = []
@@ -333,44 +612,58 @@ def _is_whitespace_or_comment_or_else(line):
 
 
 def _write_source(
-    source_lines: list[str],
+    source: SourceBuffer,
     imports: list["ClassifiedImport"],
     nosort_imports,
     import_gap_lines: set[int],
     imports_start_on: int,
     style: Any,
-):
-    buf: list[str] = []
-    previous_import = None
-    for lineno, line in enumerate(source_lines, 1):
-        if lineno == imports_start_on:
-            for import_node in imports:
-                if previous_import is not None and not style.same_section(
-                    previous_import, import_node
-                ):
-                    buf.append("")
-                previous_import = import_node
-                buf.append(_write_import(import_node))
-
-            for import_node in nosort_imports:
-                if previous_import is not None:
-                    buf.append("")
-                    previous_import = None
-                buf.append(_write_import(import_node))
-
-        if lineno not in import_gap_lines:
-            buf.append(line.rstrip())
-    return buf
+) -> SourceBuffer:
+    edits: list[tuple[int, int, Sequence[str]]] = []
+
+    if imports_start_on:
+        buf: list[str] = []
+        previous_import = None
+        for import_node in imports:
+            if previous_import is not None and not style.same_section(
+                previous_import, import_node
+            ):
+                buf.append("")
+            previous_import = import_node
+            buf.append(_write_import(import_node))
+
+        for import_node in nosort_imports:
+            if previous_import is not None:
+                buf.append("")
+                previous_import = None
+            buf.append(_write_import(import_node))
+
+        edits.append((imports_start_on - 1, imports_start_on - 1, buf))
+
+    # remove each run of consecutive import / gap lines
+    start = end = None
+    for lineno in sorted(import_gap_lines):
+        if lineno - 1 != end:
+            if start is not None:
+                edits.append((start, end, ()))
+            start = lineno - 1
+        end = lineno
+    if start is not None:
+        edits.append((start, end, ()))
+
+    return source.replace(edits)
 
 
 def _write_import(import_node: "ClassifiedImport"):
-    names = import_node.render_ast_names
+    table = import_node.table
     modules = []
-    for name in names:
-        if name.asname:
-            modules.append(f"{name.name} as {name.asname}")
+    for name_row in import_node.render_rows:
+        name = table.string(table.name_ids[name_row])
+        asname = table.string(table.asname_ids[name_row])
+        if asname:
+            modules.append(f"{name} as {asname}")
         else:
-            modules.append(name.name)
+            modules.append(name)
     modules.sort(key=lambda x: x.lower())
     modules = ", ".join(modules)
     offset = " " * import_node.col_offset
@@ -387,20 +680,202 @@ def _write_import(import_node: "ClassifiedImport"):
         )
 
 
-class ClassifiedImport(NamedTuple):
-    type: f8io.ImportType
-    is_from: bool
-    modules: list
-    names: list
-    lineno: int
-    col_offset: int
-    level: int
-    package: str
-    ast_names: Optional[str]
-    render_ast_names: list
-    nosort: bool
-    noqa_comment: Optional[str]
-    type_ignore_comment: Optional[str]
+_IS_FROM = 1
+_NOSORT = 2
+
+
+class ImportTable:
+    """Column-oriented storage for the imports found in one parse.
+
+    Each import statement is a row in the ``import_*`` columns, and each
+    name it imports is a row in the ``name_*`` columns pointing back to
+    its statement.  Strings are interned into :attr:`.strings` and the
+    columns store their integer ids, with ``-1`` meaning None.
+
+    Rows are looked at through :class:`.ClassifiedImport` views.  Names
+    added by star expansion are appended as new name rows of the star
+    import's statement.
+
+    """
+
+    __slots__ = (
+        "strings",
+        "_string_ids",
+        "_packages",
+        "import_types",
+        "import_flags",
+        "import_linenos",
+        "import_col_offsets",
+        "import_levels",
+        "import_modules",
+        "import_packages",
+        "import_noqa_comments",
+        "import_type_ignore_comments",
+        "name_imports",
+        "name_ids",
+        "asname_ids",
+    )
+
+    def __init__(self):
+        self.strings: list[str] = []
+        self._string_ids: dict[str, int] = {}
+        self._packages: dict[str, int] = {}
+
+        self.import_types = array("b")
+        self.import_flags = array("B")
+        self.import_linenos = array("i")
+        self.import_col_offsets = array("i")
+        self.import_levels = array("i")
+        self.import_modules = array("i")
+        self.import_packages = array("i")
+        self.import_noqa_comments = array("i")
+        self.import_type_ignore_comments = array("i")
+
+        self.name_imports = array("i")
+        self.name_ids = array("i")
+        self.asname_ids = array("i")
+
+    def intern(self, value: Optional[str]) -> int:
+        if value is None:
+            return -1
+        try:
+            return self._string_ids[value]
+        except KeyError:
+            id_ = self._string_ids[value] = len(self.strings)
+            self.strings.append(value)
+            return id_
+
+    def string(self, id_: int) -> Optional[str]:
+        return self.strings[id_] if id_ >= 0 else None
+
+    def _package(self, module: str) -> int:
+        # root_package_name() runs ast.parse(), so only do it once for
+        # each module name
+        try:
+            return self._packages[module]
+        except KeyError:
+            id_ = self._packages[module] = self.intern(
+                f8io.root_package_name(module)
+            )
+            return id_
+
+    def add_import(
+        self,
+        type_: f8io.ImportType,
+        is_from: bool,
+        module: Optional[str],
+        package_module: str,
+        lineno: int,
+        col_offset: int,
+        level: int,
+        nosort: bool,
+        noqa_comment: Optional[str],
+        type_ignore_comment: Optional[str],
+    ) -> int:
+        self.import_types.append(type_)
+        self.import_flags.append(
+            (_IS_FROM if is_from else 0) | (_NOSORT if nosort else 0)
+        )
+        self.import_linenos.append(lineno)
+        self.import_col_offsets.append(col_offset)
+        self.import_levels.append(level)
+        self.import_modules.append(self.intern(module))
+        self.import_packages.append(self._package(package_module))
+        self.import_noqa_comments.append(self.intern(noqa_comment))
+        self.import_type_ignore_comments.append(
+            self.intern(type_ignore_comment)
+        )
+        return len(self.import_linenos) - 1
+
+    def add_name(self, index: int, name: str, asname: Optional[str]) -> int:
+        self.name_imports.append(index)
+        self.name_ids.append(self.intern(name))
+        self.asname_ids.append(self.intern(asname))
+        return len(self.name_ids) - 1
+
+    def single(self, name_row: int) -> "ClassifiedImport":
+        """Return a view of a single name as its own import."""
+        return ClassifiedImport(self, self.name_imports[name_row], (name_row,))
+
+
+class ClassifiedImport:
+    """View of an import statement in an :class:`.ImportTable`.
+
+    ``name_rows`` are the names the view represents, which may be a
+    subset of the statement's names when imports are flattened;
+    ``render_rows`` are those of them that will be written out.
+
+    Provides the attributes that flake8-import-order styles look at.
+
+    """
+
+    __slots__ = ("table", "index", "name_rows", "render_rows")
+
+    def __init__(
+        self, table: ImportTable, index: int, name_rows: Sequence[int]
+    ):
+        self.table = table
+        self.index = index
+        self.name_rows = name_rows
+        self.render_rows = list(name_rows)
+
+    @property
+    def type(self) -> f8io.ImportType:
+        return f8io.ImportType(self.table.import_types[self.index])
+
+    @property
+    def is_from(self) -> bool:
+        return bool(self.table.import_flags[self.index] & _IS_FROM)
+
+    @property
+    def nosort(self) -> bool:
+        return bool(self.table.import_flags[self.index] & _NOSORT)
+
+    @property
+    def lineno(self) -> int:
+        return self.table.import_linenos[self.index]
+
+    @property
+    def col_offset(self) -> int:
+        return self.table.import_col_offsets[self.index]
+
+    @property
+    def level(self) -> int:
+        return self.table.import_levels[self.index]
+
+    @property
+    def package(self) -> Optional[str]:
+        return self.table.string(self.table.import_packages[self.index])
+
+    @property
+    def noqa_comment(self) -> Optional[str]:
+        return self.table.string(self.table.import_noqa_comments[self.index])
+
+    @property
+    def type_ignore_comment(self) -> Optional[str]:
+        return self.table.string(
+            self.table.import_type_ignore_comments[self.index]
+        )
+
+    @property
+    def modules(self) -> list[str]:
+        table = self.table
+        if self.is_from:
+            return [table.string(table.import_modules[self.index])]
+        else:
+            return [
+                table.strings[table.name_ids[row]] for row in self.name_rows
+            ]
+
+    @property
+    def names(self) -> list[str]:
+        table = self.table
+        if self.is_from:
+            return [
+                table.strings[table.name_ids[row]] for row in self.name_rows
+            ]
+        else:
+            return []
 
     def __hash__(self):
         return hash((self.type, self.is_from, self.lineno))
@@ -416,47 +891,50 @@ class ClassifiedImport(NamedTuple):
     def pyflakes_warning_keys(self):
         # generate keys that match what pyflakes reports in its
         # warning messages in order to match dupes found
+        table = self.table
         if not self.is_from:
-            return [(ast_name.name, ast_name) for ast_name in self.ast_names]
-        else:
             return [
-                (
+                (table.strings[table.name_ids[row]], row)
+                for row in self.name_rows
+            ]
+        else:
+            module = self.modules[0]
+            prefix = ("." * self.level) + (module + "." if module else "")
+            keys = []
+            for row in self.name_rows:
+                name = table.strings[table.name_ids[row]]
+                asname = table.string(table.asname_ids[row])
+                keys.append(
                     (
-                        ("." * self.level)
-                        + (self.modules[0] + "." if self.modules[0] else "")
-                        + (
-                            f"{ast_name.name} as {ast_name.asname}"
-                            if ast_name.asname
-                            else ast_name.name
-                        )
-                    ),
-                    ast_name,
+                        prefix + (f"{name} as {asname}" if asname else name),
+                        row,
+                    )
                 )
-                for ast_name in self.ast_names
-            ]
+            return keys
 
     @property
     def noqa(self) -> bool:
-        return self.noqa_comment is not None
+        return self.table.import_noqa_comments[self.index] >= 0
 
 
 class ImportVisitor(f8io.ImportVisitor):
     def __init__(
         self,
-        source_lines,
+        source,
         application_import_names,
         application_package_names,
         type_checking_blocks,
     ):
+        self.table = ImportTable()
         self.imports: list[ClassifiedImport] = []
-        self.source_lines = source_lines
+        self.source = source
         self.application_import_names = frozenset(application_import_names)
         self.application_package_names = frozenset(application_package_names)
         self.type_checking_blocks = type_checking_blocks
         self.top_level = type_checking_blocks is None
 
     def _get_flags(self, lineno):
-        line = self.source_lines[lineno - 1].rstrip()
+        line = self.source[lineno - 1].rstrip()
         symbols = re.match(
             r"^.*?( +# type: ignore(?:\[[^]]+\])?)?"
             r"( +# noqa\:?(?: +(?:[A-Z]\d+,? ?)+)?( *nosort)?.*)?$",
@@ -478,6 +956,29 @@ class ImportVisitor(f8io.ImportVisitor):
             not self.top_level and node.lineno in self.type_checking_blocks
         )
 
+    def _add_import(self, node, type_, is_from, module, package_module):
+        nosort, noqa_comment, type_ignore_comment = self._get_flags(
+            node.lineno
+        )
+        table = self.table
+        index = table.add_import(
+            type_,
+            is_from,
+            module,
+            package_module,
+            node.lineno,
+            node.col_offset,
+            node.level if is_from else 0,
+            nosort,
+            noqa_comment,
+            type_ignore_comment,
+        )
+        name_rows = tuple(
+            table.add_name(index, alias.name, alias.asname)
+            for alias in node.names
+        )
+        self.imports.append(ClassifiedImport(table, index, name_rows))
+
     def visit_Import(self, node):  # noqa: N802
         if self._check_node(node):
             modules = [alias.name for alias in node.names]
@@ -486,25 +987,7 @@ class ImportVisitor(f8io.ImportVisitor):
                 type_ = types_.pop()
             else:
                 type_ = f8io.ImportType.MIXED
-            nosort, noqa_comment, type_ignore_comment = self._get_flags(
-                node.lineno
-            )
-            classified_import = ClassifiedImport(
-                type_,
-                False,
-                modules,
-                [],
-                node.lineno,
-                node.col_offset,
-                0,
-                f8io.root_package_name(modules[0]),
-                node.names,
-                list(node.names),
-                nosort,
-                noqa_comment,
-                type_ignore_comment,
-            )
-            self.imports.append(classified_import)
+            self._add_import(node, type_, False, None, modules[0])
 
     def visit_ImportFrom(self, node):  # noqa: N802
         if self._check_node(node):
@@ -513,38 +996,21 @@ class ImportVisitor(f8io.ImportVisitor):
                 type_ = f8io.ImportType.APPLICATION_RELATIVE
             else:
                 type_ = self._classify_type(module)
-            names = [alias.name for alias in node.names]
-            nosort, noqa_comment, type_ignore_comment = self._get_flags(
-                node.lineno
-            )
-            classified_import = ClassifiedImport(
-                type_,
-                True,
-                [module],
-                names,
-                node.lineno,
-                node.col_offset,
-                node.level,
-                f8io.root_package_name(module),
-                node.names,
-                list(node.names),
-                nosort,
-                noqa_comment,
-                type_ignore_comment,
-            )
-            self.imports.append(classified_import)
+            self._add_import(node, type_, True, module, module)
 
 
 def _parse_toplevel_imports(
     options: Any,
     filename: str,
-    source_lines: list[str],
+    source: SourceBuffer,
     type_checking_blocks: Optional[TypeCheckingBlocks],
     drill_for_warnings: bool = False,
+    timers: PhaseTimers = NULL_TIMERS,
+    deadline: Optional[float] = None,
 ):
-    source = "\n".join(source_lines)
-
-    tree = ast.parse(source, filename)
+    with timers.phase("parse"):
+        tree = ast.parse(source.text, filename)
+    timers.count("parses")
 
     # NOTE: the line `else:` does not appear in the ast tree, since it's
     # considered inside the `if` block. It's ignored by the function
@@ -555,17 +1021,30 @@ def _parse_toplevel_imports(
         if hasattr(node, "lineno") and not isinstance(node, ast.alias)
     }
 
-    warnings = pyflakes.checker.Checker(tree, filename)
-
     if drill_for_warnings:
-        warnings_set = _drill_for_warnings(
-            options, filename, source_lines, warnings, type_checking_blocks
-        )
+        # the warnings are only used to find unused imports, so pyflakes
+        # isn't run at all otherwise, e.g. with sort_only
+        import pyflakes.checker
+
+        with timers.phase("checker"):
+            warnings = pyflakes.checker.Checker(tree, filename)
+        timers.count("checker_runs")
+
+        with timers.phase("drill"):
+            warnings_set = _drill_for_warnings(
+                options,
+                filename,
+                source,
+                warnings,
+                type_checking_blocks,
+                timers,
+                deadline,
+            )
     else:
         warnings_set = None
 
     f8io_visitor = ImportVisitor(
-        source_lines,
+        source,
         options.application_import_names.split(","),
         options.application_package_names.split(","),
         type_checking_blocks,
@@ -578,15 +1057,20 @@ def _parse_toplevel_imports(
 def _drill_for_warnings(
     options: Any,
     filename: str,
-    source_lines: list[str],
-    warnings: pyflakes.checker.Checker,
+    source: SourceBuffer,
+    warnings: "pyflakes.checker.Checker",
     type_checking_blocks: Optional[TypeCheckingBlocks],
+    timers: PhaseTimers = NULL_TIMERS,
+    deadline: Optional[float] = None,
 ):
     # pyflakes doesn't warn for all occurrences of an unused import
     # if that same symbol is repeated, so run over and over again
     # until we find every possible warning.  assumes single-line
     # imports
 
+    import pyflakes.checker
+    import pyflakes.messages
+
     ignore_errors = set()
     if options.per_file_ignores:
         abs_filename = normalize_path(filename)
@@ -594,12 +1078,13 @@ def _drill_for_warnings(
             if matches_filename(abs_filename, [normalize_path(pattern)]):
                 ignore_errors.update(codes)
 
-    source_lines = list(source_lines)
     warnings_set: set[tuple[str, int]] = set()
     seen_lineno = set()
     top_level = type_checking_blocks is None
     while True:
-        has_warnings = False
+        _check_deadline(deadline)
+        timers.count("drill_iterations")
+        removed_lines = []
         for warning in warnings.messages:
             if (
                 not isinstance(warning, pyflakes.messages.UnusedImport)
@@ -610,7 +1095,7 @@ def _drill_for_warnings(
             if "F401" in ignore_errors:
                 continue
 
-            line = source_lines[warning.lineno - 1]
+            line = source[warning.lineno - 1]
             if top_level:
                 # when dealing with "top level" imports, imports
                 # inside of conditionals or in defs aren't counted.
@@ -619,23 +1104,28 @@ def _drill_for_warnings(
             else:
                 if warning.lineno not in type_checking_blocks:
                     continue
-            has_warnings = True
             warnings_set.add((warning.message_args[0], warning.lineno))
 
             # replace the line with nothing so that we approach no more
             # warnings generated. note this would be much trickier if we are
             # trying to deal with imports inside conditionals/defs
-            source_lines[warning.lineno - 1] = ""
+            removed_lines.append(warning.lineno)
             seen_lineno.add(warning.lineno)
 
-        if not has_warnings:
+        if not removed_lines:
             break
 
+        source = source.replace(
+            (lineno - 1, lineno, ("",)) for lineno in set(removed_lines)
+        )
         if type_checking_blocks:
-            type_checking_blocks.remove_empty_blocks(source_lines)
-        source = "\n".join(source_lines)
-        tree = ast.parse(source, filename)
-        warnings = pyflakes.checker.Checker(tree, filename)
+            source = type_checking_blocks.remove_empty_blocks(source)
+        with timers.phase("parse"):
+            tree = ast.parse(source.text, filename)
+        timers.count("parses")
+        with timers.phase("checker"):
+            warnings = pyflakes.checker.Checker(tree, filename)
+        timers.count("checker_runs")
 
     return warnings_set
 
@@ -658,13 +1148,13 @@ def _remove_unused_names(
         # generate a key that matches the key we get from
         # pyflakes to match up
         new = [
-            ast_name
-            for warning_key, ast_name in import_node.pyflakes_warning_keys
+            name_row
+            for warning_key, name_row in import_node.pyflakes_warning_keys
             if (warning_key, import_node.lineno) not in remove_imports
         ]
-        removed_import_count += len(import_node.ast_names) - len(new)
-        import_node.render_ast_names[:] = new
-    new_imports = [node for node in imports if node.render_ast_names]
+        removed_import_count += len(import_node.name_rows) - len(new)
+        import_node.render_rows[:] = new
+    new_imports = [node for node in imports if node.render_rows]
 
     stats["removed_imports"] += (
         removed_import_count
@@ -676,38 +1166,42 @@ def _remove_unused_names(
 
 
 def _dedupe_single_imports(
-    import_nodes: Iterable[ClassifiedImport], stats: dict
-):
-    seen = {}
-    orig_order: list[tuple[ClassifiedImport, Any]] = []
-
-    for import_node in import_nodes:
-        if not import_node.is_from:
-            assert len(import_node.ast_names) == 1
-            hash_key = (
-                import_node.ast_names[0].name,
-                import_node.ast_names[0].asname,
-            )
+    table: ImportTable, name_rows: Iterable[int], stats: dict
+) -> Iterator[int]:
+    seen: dict[tuple[int, ...], int] = {}
+    orig_order: list[tuple[int, tuple[int, ...]]] = []
+
+    names = table.name_ids
+    asnames = table.asname_ids
+    for name_row in name_rows:
+        index = table.name_imports[name_row]
+        if not table.import_flags[index] & _IS_FROM:
+            hash_key = (names[name_row], asnames[name_row])
         else:
-            assert len(import_node.ast_names) == 1
             hash_key = (
-                import_node.modules[0],
-                import_node.level,
-                import_node.ast_names[0].name,
-                import_node.ast_names[0].asname,
+                table.import_modules[index],
+                table.import_levels[index],
+                names[name_row],
+                asnames[name_row],
             )
 
-        orig_order.append((import_node, hash_key))
+        orig_order.append((name_row, hash_key))
 
         if hash_key in seen:
-            if import_node.noqa and not seen[hash_key].noqa:
-                seen[hash_key] = import_node
+            if (
+                table.import_noqa_comments[index] >= 0
+                and table.import_noqa_comments[
+                    table.name_imports[seen[hash_key]]
+                ]
+                < 0
+            ):
+                seen[hash_key] = name_row
         else:
-            seen[hash_key] = import_node
+            seen[hash_key] = name_row
 
-    for import_node, hash_key in orig_order:
-        if seen[hash_key] is import_node:
-            yield import_node
+    for name_row, hash_key in orig_order:
+        if seen[hash_key] == name_row:
+            yield name_row
         else:
             stats["removed_imports"] += 1
 
@@ -716,64 +1210,24 @@ def _as_single_imports(
     import_nodes: list[ClassifiedImport],
     stats: dict,
     expand_stars: bool = False,
-):
+    timers: PhaseTimers = NULL_TIMERS,
+) -> Iterator[int]:
     for import_node in import_nodes:
-        if not import_node.is_from:
-            for ast_name in import_node.ast_names:
-                yield ClassifiedImport(
-                    import_node.type,
-                    import_node.is_from,
-                    [ast_name.name],
-                    [],
-                    import_node.lineno,
-                    import_node.col_offset,
-                    import_node.level,
-                    import_node.package,
-                    [ast_name],
-                    [ast_name],
-                    import_node.nosort,
-                    import_node.noqa_comment,
-                    import_node.type_ignore_comment,
-                )
-        else:
-            for ast_name in import_node.ast_names:
-                if ast_name.name == "*" and expand_stars:
-                    stats["star_imports_removed"] += 1
-                    ast_cls = type(ast_name)
+        table = import_node.table
+        for name_row in import_node.name_rows:
+            if (
+                expand_stars
+                and import_node.is_from
+                and table.strings[table.name_ids[name_row]] == "*"
+            ):
+                stats["star_imports_removed"] += 1
+                with timers.phase("expand_stars"):
                     module = importlib.import_module(import_node.modules[0])
-                    for star_name in getattr(module, "__all__", dir(module)):
-                        stats["names_from_star"] += 1
-                        yield ClassifiedImport(
-                            import_node.type,
-                            import_node.is_from,
-                            import_node.modules,
-                            [star_name],
-                            import_node.lineno,
-                            import_node.col_offset,
-                            import_node.level,
-                            import_node.package,
-                            [ast_cls(star_name, asname=None)],
-                            [ast_cls(star_name, asname=None)],
-                            import_node.nosort,
-                            import_node.noqa_comment,
-                            import_node.type_ignore_comment,
-                        )
-                else:
-                    yield ClassifiedImport(
-                        import_node.type,
-                        import_node.is_from,
-                        import_node.modules,
-                        [ast_name.name],
-                        import_node.lineno,
-                        import_node.col_offset,
-                        import_node.level,
-                        import_node.package,
-                        [ast_name],
-                        [ast_name],
-                        import_node.nosort,
-                        import_node.noqa_comment,
-                        import_node.type_ignore_comment,
-                    )
+                for star_name in getattr(module, "__all__", dir(module)):
+                    stats["names_from_star"] += 1
+                    yield table.add_name(import_node.index, star_name, None)
+            else:
+                yield name_row
 
 
 def sort_imports(style: Any, imports: list[ClassifiedImport], options: Any):
@@ -781,7 +1235,7 @@ def sort_imports(style: Any, imports: list[ClassifiedImport], options: Any):
     nosort = []
 
     for import_node in imports:
-        assert options.multi_imports or len(import_node.ast_names) == 1
+        assert options.multi_imports or len(import_node.name_rows) == 1
 
         if import_node.nosort:
             nosort.append(import_node)
@@ -792,43 +1246,431 @@ def sort_imports(style: Any, imports: list[ClassifiedImport], options: Any):
     return sorted_, nosort
 
 
-def _lines_with_newlines(lines) -> Iterator[str]:
-    for line in lines[0:-1]:
-        yield line + "\n"
-    yield lines[-1]
+def _changed_region(
+    a: Sequence[str],
+    b: Sequence[str],
+    a_len: int,
+    b_len: int,
+    bounds: Optional[tuple[int, int]] = None,
+) -> Optional[tuple[int, int]]:
+    """Return the length of the common prefix and common suffix of the
+    first ``a_len`` lines of ``a`` and ``b_len`` lines of ``b``, or None
+    if ``a`` and ``b`` are identical.
+
+    Only the import header and TYPE_CHECKING blocks are rewritten, so
+    everything outside of these two bounds is shared between the
+    original and the rewritten source.  ``bounds`` are a prefix and
+    suffix already known to be common, e.g. from
+    :meth:`.SourceBuffer.unchanged_bounds`, so that only the lines
+    between them are compared.
+
+    """
+    if bounds is None:
+        if len(a) == len(b) and a == b:
+            return None
+        bounds = 0, 0
+
+    shortest = min(a_len, b_len)
+    prefix = min(bounds[0], shortest)
+    while prefix < shortest and a[prefix] == b[prefix]:
+        prefix += 1
+    if prefix == a_len == b_len:
+        return None
+
+    shortest -= prefix
+    suffix = min(bounds[1], shortest)
+    while suffix < shortest and a[a_len - 1 - suffix] == b[b_len - 1 - suffix]:
+        suffix += 1
+
+    return prefix, suffix
+
+
+def _region_opcodes(
+    a: Sequence[str],
+    b: Sequence[str],
+    a_len: Optional[int] = None,
+    b_len: Optional[int] = None,
+    bounds: Optional[tuple[int, int]] = None,
+) -> list[tuple[str, int, int, int, int]]:
+    """Return difflib opcodes for the first ``a_len`` / ``b_len`` lines
+    of ``a`` / ``b``, defaulting to all of them.
+
+    Only the lines between the common prefix and suffix are matched;
+    the prefix and suffix themselves are reported as single "equal"
+    opcodes.  Returns an empty list if the sequences are identical.
+    See :func:`._changed_region` for ``bounds``.
+
+    """
+    if a_len is None:
+        a_len = len(a)
+    if b_len is None:
+        b_len = len(b)
+    region = _changed_region(a, b, a_len, b_len, bounds)
+    if region is None:
+        return []
+    prefix, suffix = region
+    a_end, b_end = a_len - suffix, b_len - suffix
+
+    # only imported once a file has actually changed
+    import difflib
+
+    opcodes = [("equal", 0, prefix, 0, prefix)] if prefix else []
+    matcher = difflib.SequenceMatcher(None, a[prefix:a_end], b[prefix:b_end])
+    for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+        i1, i2, j1, j2 = i1 + prefix, i2 + prefix, j1 + prefix, j2 + prefix
+        if tag == "equal" and opcodes and opcodes[-1][0] == "equal":
+            opcodes[-1] = ("equal", opcodes[-1][1], i2, opcodes[-1][3], j2)
+        else:
+            opcodes.append((tag, i1, i2, j1, j2))
+    if suffix:
+        if opcodes and opcodes[-1][0] == "equal":
+            opcodes[-1] = (
+                "equal",
+                opcodes[-1][1],
+                a_len,
+                opcodes[-1][3],
+                b_len,
+            )
+        else:
+            opcodes.append(("equal", a_end, a_len, b_end, b_len))
+    return opcodes
+
+
+def _grouped_opcodes(
+    opcodes: list[tuple[str, int, int, int, int]], context: int
+) -> Iterator[list[tuple[str, int, int, int, int]]]:
+    # same as SequenceMatcher.get_grouped_opcodes(), for opcodes that
+    # did not come from a SequenceMatcher over the full sequences
+    codes = list(opcodes)
+    if codes[0][0] == "equal":
+        tag, i1, i2, j1, j2 = codes[0]
+        codes[0] = tag, max(i1, i2 - context), i2, max(j1, j2 - context), j2
+    if codes[-1][0] == "equal":
+        tag, i1, i2, j1, j2 = codes[-1]
+        codes[-1] = tag, i1, min(i2, i1 + context), j1, min(j2, j1 + context)
+
+    group: list[tuple[str, int, int, int, int]] = []
+    for tag, i1, i2, j1, j2 in codes:
+        if tag == "equal" and i2 - i1 > context * 2:
+            group.append(
+                (tag, i1, min(i2, i1 + context), j1, min(j2, j1 + context))
+            )
+            yield group
+            group = []
+            i1, j1 = max(i1, i2 - context), max(j1, j2 - context)
+        group.append((tag, i1, i2, j1, j2))
+    if group and not (len(group) == 1 and group[0][0] == "equal"):
+        yield group
+
+
+def _format_range_unified(start: int, stop: int) -> str:
+    # same as difflib's; convert a range to the "ed" format
+    beginning = start + 1
+    length = stop - start
+    if length == 1:
+        return f"{beginning}"
+    if not length:
+        beginning -= 1
+    return f"{beginning},{length}"
+
+
+_NO_NEWLINE = "\n\\ No newline at end of file"
+
+
+class _Unterminated(Sequence[str]):
+    """View of the lines of a text that does not end with a newline, with
+    the "No newline at end of file" marker added to its last line, so
+    that it doesn't match the same line ending with a newline."""
+
+    __slots__ = ("lines", "length")
+
+    def __init__(self, lines: Sequence[str], length: int):
+        self.lines = lines
+        self.length = length
+
+    def __len__(self) -> int:
+        return self.length
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(self.length))]
+        if index < 0:
+            index += self.length
+        if index == self.length - 1:
+            return self.lines[index] + _NO_NEWLINE
+        return self.lines[index]
+
+
+_LineDiff = tuple[
+    Sequence[str], Sequence[str], list[tuple[str, int, int, int, int]]
+]
 
 
-def _mini_black_format(lines: list[str], line_length) -> Iterator[str]:
-    for line in lines:
+def _line_diff(
+    a: Sequence[str],
+    b: Sequence[str],
+    bounds: Optional[tuple[int, int]] = None,
+) -> _LineDiff:
+    """Match up the lines of two texts, as split on ``"\\n"``.
+
+    Returns the lines of each as they're shown in a diff, and the difflib
+    opcodes between them, or no opcodes if the texts are the same.  These
+    are found once for a rewritten file, and used for its stats, its
+    ``--diff`` and ``--patch``, and to find its import header.  See
+    :func:`._changed_region` for ``bounds``.
+
+    """
+    # a text that ends with a newline splits into a last line that is ""
+    # and isn't a line of the file
+    a_newline = a[-1] == ""
+    b_newline = b[-1] == ""
+    a_len = len(a) - a_newline
+    b_len = len(b) - b_newline
+
+    if not a_newline:
+        a = _Unterminated(a, a_len)
+    if not b_newline:
+        b = _Unterminated(b, b_len)
+    if bounds is not None:
+        # leave out the last line, which may have been marked above, and
+        # the "" after it
+        bounds = (
+            max(min(bounds[0], a_len - 1, b_len - 1), 0),
+            max(bounds[1] - 1, 0),
+        )
+
+    return a, b, _region_opcodes(a, b, a_len, b_len, bounds)
+
+
+def _unified_diff(
+    a: Sequence[str],
+    b: Sequence[str],
+    fromfile: str,
+    tofile: str,
+    context: int = 3,
+    diff: Optional[_LineDiff] = None,
+) -> Iterator[str]:
+    """Produce a unified diff of the lines of two texts, in the same
+    format as ``difflib.unified_diff()``, without copying or matching the
+    lines outside of the rewritten region.
+
+    Context lines are taken from the original text surrounding the
+    region, and hunk offsets are relative to the full file.  A text that
+    does not end with a newline gets a "No newline at end of file"
+    marker, so that the output can be used with ``patch`` / ``git apply``.
+    ``diff`` is the :func:`._line_diff` of the texts, if it's been found
+    already.
+
+    """
+    a, b, opcodes = diff if diff is not None else _line_diff(a, b)
+    if not opcodes:
+        return
+
+    yield f"--- {fromfile}\n"
+    yield f"+++ {tofile}\n"
+
+    for group in _grouped_opcodes(opcodes, context):
+        first, last = group[0], group[-1]
+        file1_range = _format_range_unified(first[1], last[2])
+        file2_range = _format_range_unified(first[3], last[4])
+        yield f"@@ -{file1_range} +{file2_range} @@\n"
+
+        for tag, i1, i2, j1, j2 in group:
+            if tag == "equal":
+                for i in range(i1, i2):
+                    yield f" {a[i]}\n"
+                continue
+            if tag in ("replace", "delete"):
+                for i in range(i1, i2):
+                    yield f"-{a[i]}\n"
+            if tag in ("replace", "insert"):
+                for j in range(j1, j2):
+                    yield f"+{b[j]}\n"
+
+
+def _mini_black_format(source: SourceBuffer, line_length) -> SourceBuffer:
+    edits: list[tuple[int, int, Sequence[str]]] = []
+    for index, line in enumerate(source):
         if len(line) >= line_length:
             from_imp_match = re.match(r"^(\s*)from (.+?) import (.+)", line)
-            if not from_imp_match:
-                yield line
-            else:
+            if from_imp_match:
                 leading_whitespace = from_imp_match.group(1)
                 module = from_imp_match.group(2)
                 names = re.split(r", ", from_imp_match.group(3))
-                yield f"{leading_whitespace}from {module} import ("
-                for name in names:
-                    yield f"{leading_whitespace}    {name},"
-                yield ")"
-        else:
-            yield line
+                edits.append(
+                    (
+                        index,
+                        index + 1,
+                        [f"{leading_whitespace}from {module} import ("]
+                        + [
+                            f"{leading_whitespace}    {name},"
+                            for name in names
+                        ]
+                        + [")"],
+                    )
+                )
+    return source.replace(edits)
+
+
+#: files at least this large are mapped into memory rather than read
+_MMAP_THRESHOLD = 1 << 20
+
+#: how much of the start of a file is looked at for skip markers
+_SKIP_SCAN_SIZE = 4096
+
+#: files with this near their start are left alone, as are those with
+#: any of the ``--generated-marker`` strings
+SKIP_FILE_DIRECTIVE = "# zimports: skip-file"
+
 
+class _SkipFile(Exception):
+    """Raised by :func:`._read_python_source` for a file that's to be left
+    alone, before it's decoded.  ``text`` is the file's text as it is,
+    if it was asked for so that the file can be echoed to stdout."""
+
+    text: Optional[str] = None
+
+    def __init__(self, reason: str, size: int, digest: Optional[str]):
+        super().__init__(reason, size, digest)
+        self.reason = reason
+        self.size = size
+        self.digest = digest
+
+
+class _Resumed(_SkipFile):
+    """Raised by :func:`._read_python_source` for a file that's unchanged
+    since it was recorded in the ``--checkpoint`` being resumed from."""
+
+    def __init__(self, size: int, digest: str, is_changed: bool):
+        super().__init__("unchanged since checkpoint", size, digest)
+        self.is_changed = is_changed
+
+
+def _read_python_source(
+    filename: str,
+    skip_markers: Sequence[bytes] = (),
+    checkpoint: Optional[dict[str, tuple[str, bool]]] = None,
+    echo: bool = False,
+) -> tuple[list[str], Optional[str], int, Optional[str]]:
+    """Read and decode a Python source file.
+
+    Returns its lines, with trailing whitespace stripped, the encoding to
+    write it back out with if it's not UTF-8, the size of the file in
+    bytes, and a digest of its content if ``checkpoint`` was given.
+
+    If any of ``skip_markers`` appear in the first few KB of the file,
+    :class:`._SkipFile` is raised before anything is decoded.
+    ``checkpoint`` is ``{filename: (digest, is_changed)}`` for the files
+    recorded by a ``--checkpoint`` being resumed from; if the file is one
+    of these and its digest is the same, :class:`._Resumed` is raised.
+    With ``echo``, either exception carries the file's text as it is.
+    Stdin is checked for ``skip_markers`` and always echoed, but isn't
+    looked up in ``checkpoint``.
 
-def _read_python_source(filename):
+    """
     if filename == "-":
-        file_content = sys.stdin.buffer.read()
-    else:
-        with open(filename, "rb") as file_:
-            file_content = file_.read()
+        return _screen_python_source(
+            filename, sys.stdin.buffer.read(), skip_markers, None, True
+        )
+
+    with open(filename, "rb") as file_:
+        size = os.fstat(file_.fileno()).st_size
+        if size < _MMAP_THRESHOLD:
+            return _screen_python_source(
+                filename, file_.read(), skip_markers, checkpoint, echo
+            )
+
+        import mmap
+
+        with mmap.mmap(file_.fileno(), 0, access=mmap.ACCESS_READ) as content:
+            return _screen_python_source(
+                filename, content, skip_markers, checkpoint, echo
+            )
 
-    # ensure the filehandle is seekable, which is not the
-    # case if a stdin stream was sent, see #17
-    with io.BytesIO(file_content) as file_:
-        encoding_comment = _parse_magic_encoding_comment(file_)
-        text = importlib.util.decode_source(file_.read())
-        return text.split("\n"), encoding_comment
+
+def _screen_python_source(
+    filename: str,
+    content: Any,
+    skip_markers: Sequence[bytes],
+    checkpoint: Optional[dict[str, tuple[str, bool]]],
+    echo: bool,
+) -> tuple[list[str], Optional[str], int, Optional[str]]:
+    try:
+        digest = None
+        if checkpoint is not None:
+            digest = _digest(content)
+            entry = checkpoint.get(filename)
+            if entry is not None and entry[0] == digest:
+                raise _Resumed(len(content), digest, entry[1])
+
+        if skip_markers:
+            head = content[:_SKIP_SCAN_SIZE]
+            for marker in skip_markers:
+                if marker in head:
+                    raise _SkipFile(
+                        f"found {marker.decode('utf-8')!r}",
+                        len(content),
+                        digest,
+                    )
+    except _SkipFile as skip:
+        if echo:
+            skip.text = _decode_verbatim(content)
+        raise
+
+    return (*_decode_python_source(content), digest)
+
+
+def _decode_verbatim(content: Any) -> str:
+    """Decode a file that's left alone, keeping its newlines and
+    whitespace, and a BOM if it has one."""
+    with io.BytesIO(content) as file_:
+        encoding = _parse_magic_encoding_comment(file_)
+    return str(content, encoding or "utf-8")
+
+
+def _digest(content: Any) -> str:
+    import hashlib
+
+    return hashlib.blake2b(content, digest_size=16).hexdigest()
+
+
+def _decode_python_source(
+    content: Any,
+) -> tuple[list[str], Optional[str], int]:
+    # a coding cookie can only be on one of the first two lines
+    end = content.find(b"\n")
+    if end != -1:
+        end = content.find(b"\n", end + 1)
+    head = content[:end] if end != -1 else content[:]
+
+    text = None
+    encoding_comment = None
+    if not head.startswith(codecs.BOM_UTF8) and b"coding" not in head:
+        # no BOM or coding cookie, so it's UTF-8; decode straight from
+        # the buffer, which for a mmap means without a copy as bytes
+        try:
+            text = str(content, "utf-8")
+        except UnicodeDecodeError:
+            # let decode_source() raise the same error it always has
+            pass
+        else:
+            if "\r" in text:
+                # universal newlines, as decode_source() does; unlike it,
+                # a lone CR at the very end is kept as the final newline
+                text = text.replace("\r\n", "\n").replace("\r", "\n")
+
+    if text is None:
+        # ensure the filehandle is seekable, which is not the
+        # case if a stdin stream was sent, see #17
+        with io.BytesIO(content) as file_:
+            encoding_comment = _parse_magic_encoding_comment(file_)
+            text = importlib.util.decode_source(file_.read())
+
+    return (
+        [line.rstrip() for line in text.split("\n")],
+        encoding_comment,
+        len(content),
+    )
 
 
 # Regexp to match python magic encoding line
@@ -887,25 +1729,894 @@ def _parse_magic_encoding_comment(fp):
         fp.seek(pos)
 
 
-def _run_file(options, filename):
-    lines, encoding_comment = _read_python_source(filename)
-    source_lines = [line.rstrip() for line in lines]
+@dc.dataclass
+class FileResult:
+    """The outcome of running zimports over one file.
 
-    if options.keep_unused:
-        if options.heuristic_unused:
-            raise Exception(
-                "keep-unused and heuristic-unused are mutually exclusive"
-            )
-        options.heuristic_unused = 0
-        options.keep_unused_type_checking = True
-    result, stats = Rewriter(options, filename, source_lines).rewrite()
+    Workers return these to the parent process, which does all of the
+    writing to stdout / stderr.
+
+    """
+
+    filename: str
+    stats: dict
+    output: Optional[str] = None
+    diff: Optional[str] = None
+    patch: Optional[str] = None
+    bytes_read: int = 0
+    bytes_written: int = 0
+    io_wait: float = 0.0
+    cpu_time: float = 0.0
+    timings: Optional[dict[str, float]] = None
+    counters: Optional[dict[str, int]] = None
+    pid: Optional[int] = None
+    tid: Optional[int] = None
+    trace_events: Optional[list[tuple[str, float, float]]] = None
+    profile: Optional[dict] = None
+    samples: Optional[dict[str, int]] = None
+    memory: Optional[dict[str, Optional[int]]] = None
+    skipped: Optional[str] = None
+    guard: Optional[str] = None
+    error: Optional[dict[str, str]] = None
+    resumed: bool = False
+    digest: Optional[str] = None
+
+    @property
+    def is_changed(self) -> bool:
+        return self.stats["is_changed"]
+
+
+def _patch_path(filename: str) -> str:
+    return os.path.relpath(filename).replace(os.sep, "/")
+
+
+class _StackSampler:
+    """Samples the stack of the main thread at a fixed interval while it's
+    processing a file, counting how often each distinct stack is seen.
+
+    Where ``signal.setitimer()`` is available, samples are taken from a
+    ``SIGPROF`` handler, which fires only while the process is using CPU
+    and costs nothing in between.  Elsewhere, a thread takes the samples.
+
+    """
+
+    def __init__(self, interval: float):
+        self.interval = interval
+        self.counts: dict[tuple[Any, ...], int] = {}
+        self._stop: Any = None
+
+    def _sample(self, frame: Any) -> None:
+        root = _process_file.__code__
+        stack = []
+        while frame is not None:
+            stack.append(frame.f_code)
+            if frame.f_code is root:
+                break
+            frame = frame.f_back
+        else:
+            # not inside _process_file(), e.g. starting up or stopping
+            return
+        key = tuple(stack)
+        self.counts[key] = self.counts.get(key, 0) + 1
+
+    def __enter__(self) -> "_StackSampler":
+        import signal
+
+        if hasattr(signal, "setitimer"):
+            previous = signal.signal(
+                signal.SIGPROF, lambda signum, frame: self._sample(frame)
+            )
+            signal.setitimer(signal.ITIMER_PROF, self.interval, self.interval)
+
+            def stop():
+                signal.setitimer(signal.ITIMER_PROF, 0)
+                signal.signal(signal.SIGPROF, previous)
+
+        else:
+            import threading
+
+            stopped = threading.Event()
+            ident = threading.get_ident()
+
+            def run():
+                while not stopped.wait(self.interval):
+                    frame = sys._current_frames().get(ident)
+                    if frame is not None:
+                        self._sample(frame)
+
+            thread = threading.Thread(target=run, daemon=True)
+            thread.start()
+
+            def stop():
+                stopped.set()
+                thread.join()
+
+        self._stop = stop
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self._stop()
+
+    def collapsed(self) -> dict[str, int]:
+        """The counts keyed on stacks in the "collapsed" form read by
+        flamegraph tools, outermost frame first."""
+        collapsed: dict[str, int] = {}
+        for stack, count in self.counts.items():
+            key = ";".join(
+                f"{code.co_name} ({code.co_filename}:{code.co_firstlineno})"
+                for code in reversed(stack)
+            )
+            collapsed[key] = collapsed.get(key, 0) + count
+        return collapsed
+
+
+def _peak_rss() -> Optional[int]:
+    """The high-water mark of this process's resident set size in bytes,
+    or None where the ``resource`` module isn't available."""
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes, except on macOS
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+class _MemoryMeter:
+    """Measures the memory used by a worker while it processes a file.
+
+    Records the worker's peak RSS, and how much the file raised it by;
+    with ``trace_malloc=True``, also the peak of memory allocated while
+    processing the file, using :mod:`tracemalloc`.
+
+    """
+
+    def __init__(self, trace_malloc: bool):
+        self.trace_malloc = trace_malloc
+        self.memory: dict[str, Optional[int]] = {}
+
+    def __enter__(self) -> "_MemoryMeter":
+        self._rss_before = _peak_rss()
+        if self.trace_malloc:
+            import tracemalloc
+
+            tracemalloc.start()
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        if self.trace_malloc:
+            import tracemalloc
+
+            self.memory["tracemalloc_peak"] = tracemalloc.get_traced_memory()[
+                1
+            ]
+            tracemalloc.stop()
+        rss = _peak_rss()
+        self.memory["rss_peak"] = rss
+        if rss is not None and self._rss_before is not None:
+            self.memory["rss_growth"] = rss - self._rss_before
+
+
+_Batch = list[tuple[int, str]]
+
+
+class _FileIO:
+    """Reads files ahead of when they're processed, and writes rewritten
+    files behind, on small thread pools, so that waiting on I/O overlaps
+    with rewriting.
+
+    ``filenames`` are the files that will be read, in order; up to
+    ``prefetch`` of them are read and decoded ahead of the one being
+    processed.  With ``prefetch=0``, files are read when asked for.
+    The first file is read when asked for too, and the threads are only
+    started once there's a file after it, so that a single file, e.g.
+    from a pre-commit hook, is read and written without any.
+    Files with any of ``skip_markers`` near their start, or unchanged
+    since they were recorded in ``checkpoint``, aren't decoded, see
+    :func:`._read_python_source`; with ``echo``, they carry their text
+    so that they can be written to stdout as they are.
+
+    Writes are atomic, see :func:`._write_python_source`.  ``fsync`` is
+    the ``--fsync`` policy: ``"file"`` syncs each file as it's written,
+    ``"end"`` syncs all of them once they've been written, and
+    ``"never"`` leaves it to the OS.
+
+    """
+
+    def __init__(
+        self,
+        filenames: Iterable[str],
+        prefetch: int,
+        fsync: str = "never",
+        skip_markers: Sequence[bytes] = (),
+        checkpoint: Optional[dict[str, tuple[str, bool]]] = None,
+        echo: bool = False,
+    ):
+        from collections import deque
+
+        self._filenames = iter(filenames)
+        self._prefetch = prefetch
+        # the files after the one being processed, with the future of
+        # their read if they're being read ahead
+        self._reads: Any = deque()
+        self._reader: Any = None
+        self._writer: Any = None
+        self._writes: dict[str, Any] = {}
+        self._fsync = fsync
+        self._skip_markers = skip_markers
+        self._checkpoint = checkpoint
+        self._echo = echo
+
+    def _read_ahead(self) -> None:
+        while len(self._reads) < max(self._prefetch, 1):
+            filename = next(self._filenames, None)
+            if filename is None:
+                return
+            future = None
+            if self._prefetch:
+                if self._reader is None:
+                    from concurrent.futures import ThreadPoolExecutor
+
+                    self._reader = ThreadPoolExecutor(
+                        self._prefetch, thread_name_prefix="zimports-read"
+                    )
+                future = self._reader.submit(
+                    _read_python_source,
+                    filename,
+                    self._skip_markers,
+                    self._checkpoint,
+                    self._echo,
+                )
+            self._reads.append((filename, future))
+
+    def read(
+        self, filename: str
+    ) -> tuple[list[str], Optional[str], int, Optional[str], float]:
+        """Return ``_read_python_source(filename)``, along with the time
+        spent waiting for it."""
+        start = time.perf_counter()
+        future = None
+        if self._reads and self._reads[0][0] == filename:
+            _, future = self._reads.popleft()
+        elif not self._reads:
+            next(self._filenames, None)
+        self._read_ahead()
+        if future is not None:
+            data = future.result()
+        else:
+            data = _read_python_source(
+                filename, self._skip_markers, self._checkpoint, self._echo
+            )
+        return (*data, time.perf_counter() - start)
+
+    def _submit_write(self, filename: str, fn: Any, *args: Any) -> None:
+        if self._writer is None and not self._reads:
+            # no file to rewrite while this one is written
+            self._writes[filename] = _Finished(fn, *args)
+            return
+        if self._writer is None:
+            from concurrent.futures import ThreadPoolExecutor
+
+            self._writer = ThreadPoolExecutor(
+                1, thread_name_prefix="zimports-write"
+            )
+        self._writes[filename] = self._writer.submit(fn, *args)
+
+    def write(self, filename: str, content: bytes) -> None:
+        self._submit_write(
+            filename,
+            _write_python_source,
+            filename,
+            content,
+            self._fsync == "file",
+        )
+
+    def write_header(self, filename: str, header: bytes, offset: int) -> None:
+        self._submit_write(
+            filename,
+            _write_python_header,
+            filename,
+            header,
+            offset,
+            self._fsync == "file",
+        )
+
+    def pending(self, filename: str) -> Any:
+        """Return the future for the write of ``filename``, or None if it
+        wasn't written."""
+        return self._writes.get(filename)
+
+    def close(self) -> None:
+        """Wait for all writes to finish, and discard any files that were
+        read ahead.  Errors from writes are left to :meth:`.pending`."""
+        if self._reader is not None:
+            self._reader.shutdown(wait=False, cancel_futures=True)
+        if self._writer is not None:
+            self._writer.shutdown(wait=True)
+        written = [
+            future.result()
+            for future in self._writes.values()
+            if future.exception() is None
+        ]
+        if self._fsync == "end":
+            for path in written:
+                _fsync_path(path)
+            for directory in {os.path.dirname(path) for path in written}:
+                _fsync_path(directory)
+
+
+class _Finished:
+    """A write that :class:`._FileIO` ran in the calling thread, with the
+    parts of the ``Future`` interface that are used of the writes it
+    runs on its thread."""
+
+    __slots__ = ("_result", "_error")
+
+    def __init__(self, fn: Any, *args: Any):
+        self._result = self._error = None
+        try:
+            self._result = fn(*args)
+        except Exception as err:
+            self._error = err
+
+    def done(self) -> bool:
+        return True
+
+    def exception(self) -> Optional[Exception]:
+        return self._error
+
+    def result(self) -> Any:
+        if self._error is not None:
+            raise self._error
+        return self._result
+
+
+def _encode_output(text: str, encoding: Optional[str]) -> bytes:
+    # the same as writing in text mode would produce
+    if os.linesep != "\n":
+        text = text.replace("\n", os.linesep)
+    return text.encode(encoding if encoding else "utf-8")
+
+
+def _write_python_source(
+    filename: str, content: bytes, fsync: bool = False
+) -> str:
+    """Replace the contents of a file atomically with ``content``.
+
+    See :func:`._replace_file`.  Returns the path written to.
+
+    """
+    return _replace_file(filename, lambda file_: file_.write(content), fsync)
+
+
+def _write_python_header(
+    filename: str, header: bytes, offset: int, fsync: bool = False
+) -> str:
+    """Replace everything before byte ``offset`` of a file with ``header``,
+    atomically, copying the rest of it over unchanged.
+
+    The tail is copied with ``os.copy_file_range()`` or ``os.sendfile()``
+    where the platform has them, so that it's never read into memory.
+    Returns the path written to.
+
+    """
+
+    def write(file_):
+        file_.write(header)
+        file_.flush()
+        with open(filename, "rb") as src:
+            _copy_tail(src, file_, offset)
+
+    return _replace_file(filename, write, fsync)
+
+
+def _copy_tail(src: Any, dst: Any, offset: int) -> None:
+    """Copy ``src`` from byte ``offset`` to its end onto the end of
+    ``dst``."""
+    remaining = os.fstat(src.fileno()).st_size - offset
+    src_fd, dst_fd = src.fileno(), dst.fileno()
+
+    if hasattr(os, "copy_file_range"):
+        try:
+            while remaining > 0:
+                copied = os.copy_file_range(
+                    src_fd, dst_fd, remaining, offset_src=offset
+                )
+                if not copied:
+                    return
+                offset += copied
+                remaining -= copied
+            return
+        except OSError:
+            # e.g. EXDEV or ENOSYS; carry on from where it got to
+            pass
+
+    if hasattr(os, "sendfile"):
+        try:
+            while remaining > 0:
+                copied = os.sendfile(dst_fd, src_fd, offset, remaining)
+                if not copied:
+                    return
+                offset += copied
+                remaining -= copied
+            return
+        except OSError:
+            pass
+
+    src.seek(offset)
+    dst.seek(0, os.SEEK_END)
+    shutil.copyfileobj(src, dst)
+
+
+def _replace_file(filename: str, write: Any, fsync: bool = False) -> str:
+    """Replace a file atomically.
+
+    ``write`` is called with a binary file object to write the new
+    content to; this is a temporary file in the same directory, which is
+    then renamed over the original, so that an interrupted run never
+    leaves a file half written.  The file's mode, and where allowed its
+    owner, are kept, and a symlink is followed so that its target is
+    replaced, not the link.  Returns the path written to.
+
+    A file with more than one hard link, so that the links keep sharing
+    it, or one in a directory where the temporary file can't be created,
+    is instead written to an anonymous temporary file and copied back
+    over in place; this isn't atomic.
+
+    """
+    import tempfile
+
+    path = os.path.realpath(filename)
+    directory, name = os.path.split(path)
+    st = os.stat(path)
+    in_place = st.st_nlink > 1
+    if not in_place:
+        try:
+            fd, tmp = tempfile.mkstemp(
+                dir=directory, prefix=f".{name}.", suffix=".tmp"
+            )
+        except OSError:
+            # e.g. a writable file in a read-only directory
+            in_place = True
+    if in_place:
+        with tempfile.TemporaryFile() as file_:
+            write(file_)
+            file_.seek(0)
+            with open(path, "r+b") as original:
+                shutil.copyfileobj(file_, original)
+                original.truncate()
+                if fsync:
+                    original.flush()
+                    os.fsync(original.fileno())
+        return path
+
+    try:
+        with open(fd, "wb") as file_:
+            write(file_)
+            if fsync:
+                file_.flush()
+                os.fsync(file_.fileno())
+        if hasattr(os, "chown"):
+            try:
+                os.chown(tmp, st.st_uid, st.st_gid)
+            except PermissionError:
+                # only root can give a file away
+                pass
+        os.chmod(tmp, stat.S_IMODE(st.st_mode))
+        os.replace(tmp, path)
+    except BaseException:
+        try:
+            os.unlink(tmp)
+        except OSError:
+            pass
+        raise
+    if fsync:
+        _fsync_path(directory)
+    return path
+
+
+def _fsync_path(path: str) -> None:
+    """fsync a file or directory, if the platform allows it."""
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        # e.g. directories can't be opened on Windows
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+def _iter_batch(
+    options: Any, batch: Iterable[tuple[int, str]]
+) -> Iterator[tuple[int, FileResult]]:
+    """Run a batch of files, yielding ``(index, result)`` for each.
+
+    A file that fails, whether in reading, rewriting or writing it, gets
+    an error result (see :func:`._error_result`) and the batch carries on.
+    A file's result is held back until it has been written, which is
+    usually by the time the next file has been rewritten.
+
+    """
+    from collections import deque
+
+    batch, ahead = tee(batch)
+    file_io = _FileIO(
+        (filename for _, filename in ahead),
+        options.prefetch,
+        options.fsync,
+        [
+            marker.encode("utf-8")
+            for marker in (SKIP_FILE_DIRECTIVE, *options.generated_markers)
+        ],
+        options.resume_from if options.checkpoint else None,
+        _to_stdout(options),
+    )
+    waiting: Any = deque()
+    try:
+        for index, filename in batch:
+            starttime = time.perf_counter()
+            cpu_start = time.thread_time()
+            try:
+                result = _run_file(options, filename, file_io)
+            except Exception as err:
+                result = _error_result(
+                    filename, err, time.perf_counter() - starttime
+                )
+            else:
+                result.cpu_time = time.thread_time() - cpu_start
+            waiting.append((index, result, file_io.pending(filename)))
+            while waiting and (
+                len(waiting) > 1
+                or waiting[0][2] is None
+                or waiting[0][2].done()
+            ):
+                yield _written(*waiting.popleft())
+        while waiting:
+            yield _written(*waiting.popleft())
+    finally:
+        file_io.close()
+
+
+def _written(index: int, result: FileResult, write: Any):
+    """Wait for the write of a file, returning ``(index, result)``, with
+    an error result in place of ``result`` if the write failed."""
+    if write is not None:
+        try:
+            write.result()
+        except Exception as err:
+            return index, _error_result(
+                result.filename, err, result.stats["totaltime"]
+            )
+    return index, result
+
+
+def _error_result(
+    filename: str, err: Exception, totaltime: float
+) -> FileResult:
+    """A :class:`.FileResult` for a file that couldn't be run, recording
+    the type and message of the exception raised."""
+    return FileResult(
+        filename,
+        {"is_changed": False, "totaltime": totaltime},
+        error={"type": type(err).__name__, "message": str(err)},
+    )
+
+
+def _to_stdout(options, filename: Optional[str] = None) -> bool:
+    """Whether a file's text goes to stdout, rather than being written
+    back, diffed or checked."""
+    if options.diff or options.patch or options.check:
+        return False
+    return bool(options.stdout) or filename == "-"
+
+
+def _run_file(options, filename, file_io: _FileIO) -> FileResult:
+    if not options.sample and not options.memory_report:
+        return _process_file(options, filename, file_io)
+
+    with contextlib.ExitStack() as stack:
+        if options.memory_report:
+            meter = stack.enter_context(_MemoryMeter(options.trace_malloc))
+        if options.sample:
+            sampler = stack.enter_context(
+                _StackSampler(options.sample_interval / 1000)
+            )
+        result = _process_file(options, filename, file_io)
+
+    if options.sample:
+        result.samples = sampler.collapsed()
+    if options.memory_report:
+        result.pid = os.getpid()
+        result.memory = meter.memory
+    return result
+
+
+def _process_file(options, filename, file_io: _FileIO) -> FileResult:
+    starttime = time.perf_counter()
+    if options.timings or options.trace:
+        timers = PhaseTimers(trace=bool(options.trace))
+    else:
+        timers = NULL_TIMERS
+
+    with timers.phase("read"):
+        try:
+            lines, encoding_comment, bytes_read, digest, io_wait = (
+                file_io.read(filename)
+            )
+        except _SkipFile as skip:
+            result = FileResult(
+                filename,
+                {
+                    "is_changed": False,
+                    "totaltime": time.perf_counter() - starttime,
+                },
+                bytes_read=skip.size,
+                digest=skip.digest,
+            )
+            if isinstance(skip, _Resumed):
+                result.stats["is_changed"] = skip.is_changed
+                result.resumed = True
+            else:
+                result.skipped = skip.reason
+            if _to_stdout(options, filename):
+                result.output = skip.text
+            return _finish_trace(result, filename, starttime)
+        source = SourceBuffer.from_lines(lines)
+
+    if options.profile:
+        import cProfile
+
+        profiler = cProfile.Profile()
+
+    # a file over --max-file-size is only sorted; one that takes longer
+    # than --per-file-timeout is tried again sorting only, then skipped
+    sort_only = bool(
+        options.max_file_size
+        and bytes_read > options.max_file_size * (1 << 20)
+    )
+    guard = "--max-file-size" if sort_only else None
+    while True:
+        rewriter = Rewriter(
+            options,
+            filename,
+            source,
+            timers,
+            sort_only=sort_only,
+            deadline=(
+                time.perf_counter() + options.per_file_timeout
+                if options.per_file_timeout
+                else None
+            ),
+        )
+        try:
+            if options.profile:
+                rewritten, stats = profiler.runcall(rewriter.rewrite)
+            else:
+                rewritten, stats = rewriter.rewrite()
+        except TimeoutError:
+            guard = "--per-file-timeout"
+            if not sort_only:
+                sort_only = True
+                continue
+            stats = {
+                "is_changed": False,
+                "totaltime": time.perf_counter() - starttime,
+            }
+            rewritten = None
+        break
+
+    if options.profile:
+        profiler.create_stats()
+    result = FileResult(
+        filename,
+        stats,
+        bytes_read=bytes_read,
+        io_wait=io_wait,
+        guard=guard,
+        digest=digest,
+    )
+    if options.profile:
+        result.profile = profiler.stats  # type: ignore[attr-defined]
+    if options.timings:
+        result.timings = timers.times
+        result.counters = timers.counts
+    if options.trace:
+        import threading
+
+        result.pid = os.getpid()
+        result.tid = threading.get_native_id()
+        result.trace_events = timers.events
+
+    if rewritten is None:
+        result.skipped = f"over {guard}"
+        if _to_stdout(options, filename):
+            # left alone, the same as a file with nothing to change
+            result.output = source.text
+    if options.statsonly or rewritten is None:
+        return _finish_trace(result, filename, starttime)
+
+    if options.diff:
+        with timers.phase("diff"):
+            result.diff = "".join(
+                _unified_diff(
+                    source.lines,
+                    rewritten.lines,
+                    filename,
+                    filename,
+                    diff=rewriter.diff,
+                )
+            )
+    if options.patch:
+        path = _patch_path(filename)
+        with timers.phase("diff"):
+            result.patch = "".join(
+                _unified_diff(
+                    source.lines,
+                    rewritten.lines,
+                    f"a/{path}",
+                    f"b/{path}",
+                    diff=rewriter.diff,
+                )
+            )
+
+    if _to_stdout(options, filename):
+        result.output = rewritten.text
+    elif options.diff or options.patch or options.check:
+        pass
+    elif stats["is_changed"]:
+        if (
+            options.large_file_size
+            and bytes_read >= options.large_file_size * (1 << 20)
+        ):
+            _write_header_only(
+                result,
+                filename,
+                source,
+                rewriter.diff,
+                encoding_comment,
+                file_io,
+            )
+        else:
+            with timers.phase("write"):
+                content = _encode_output(rewritten.text, encoding_comment)
+                file_io.write(filename, content)
+            result.bytes_written = len(content)
+            if digest is not None:
+                result.digest = _digest(content)
+    return _finish_trace(result, filename, starttime)
+
+
+def _write_header_only(
+    result: FileResult,
+    filename: str,
+    source: SourceBuffer,
+    diff: _LineDiff,
+    encoding: Optional[str],
+    file_io: _FileIO,
+) -> None:
+    """Write a large file by replacing only its import header, copying the
+    rest of the file over byte for byte; if the change can't be confined
+    to the header, mark the file as skipped and leave it alone."""
+    header = _import_header(source.lines, diff)
+    offset = None
+    if header is not None:
+        new_header, tail_line = header
+        offset = _line_offset(filename, tail_line)
+    if offset is None:
+        result.skipped = "import header can't be isolated"
+        return
+
+    offset, newline = offset
+    content = "".join(line + newline for line in new_header).encode(
+        encoding if encoding else "utf-8"
+    )
+    file_io.write_header(filename, content, offset)
+    result.bytes_written = len(content) + result.bytes_read - offset
+    # the digest of what's written would need the whole file read back,
+    # so it's left out of --checkpoint and will be looked at again
+    result.digest = None
+
+
+def _import_header(
+    a: Sequence[str], diff: _LineDiff
+) -> Optional[tuple[Sequence[str], int]]:
+    """Given the original lines of a file and their :func:`._line_diff`
+    with the rewritten ones, return the lines of the new header and the
+    index of the first original line after it, if everything that
+    changed is within the leading run of imports, docstrings and blocks
+    of these at the top of the file."""
+    a_lines, b, opcodes = diff
+    if not opcodes:
+        return None
+    tag, end, a_len, b_end, b_len = opcodes[-1]
+    if tag != "equal":
+        if len(a_lines) == a_len or len(b) == b_len:
+            # the last line changed, and it doesn't end with a newline
+            # that the tail could start after
+            return None
+        # everything up to the final newline is the header
+        end, b_end = a_len, b_len
+    try:
+        tree = ast.parse("\n".join(a[:end]))
+    except SyntaxError:
+        # the change ends partway through a statement
+        return None
+    if not all(_is_header_statement(node) for node in tree.body):
+        return None
+    return b[:b_end], end
+
+
+def _is_header_statement(node: ast.stmt) -> bool:
+    if isinstance(node, (ast.Import, ast.ImportFrom)):
+        return True
+    elif isinstance(node, ast.Expr):
+        return isinstance(node.value, ast.Constant)
+    elif isinstance(node, (ast.If, ast.Try)):
+        children = node.body + node.orelse
+        if isinstance(node, ast.Try):
+            children += node.finalbody
+            for handler in node.handlers:
+                children += handler.body
+        return all(_is_header_statement(child) for child in children)
+    else:
+        return False
+
+
+def _line_offset(filename: str, line: int) -> Optional[tuple[int, str]]:
+    """Return the byte offset of the start of the given line of a file,
+    and the newline used by the lines before it, or None if any of those
+    lines end with a lone carriage return, which the offset can't be
+    found from."""
+    head = b""
+    offset = 0
+    with open(filename, "rb") as file_:
+        for _ in range(line):
+            found = head.find(b"\n", offset)
+            while found == -1:
+                chunk = file_.read(1 << 16)
+                if not chunk:
+                    return None
+                start = len(head)
+                head += chunk
+                found = head.find(b"\n", start)
+            offset = found + 1
+
+    head = head[:offset]
+    crlf = head.count(b"\r\n")
+    if head.count(b"\r") != crlf:
+        return None
+    return offset, "\r\n" if crlf and crlf == head.count(b"\n") else "\n"
+
+
+def _finish_trace(
+    result: FileResult, filename: str, starttime: float
+) -> FileResult:
+    if result.trace_events is not None:
+        result.trace_events.append((filename, starttime, time.perf_counter()))
+    return result
+
+
+def _format_status(options, result: FileResult) -> str:
+    stats = result.stats
     totaltime = stats["totaltime"]
-    if not stats["is_changed"]:
-        sys.stderr.write(
-            f"[Unchanged]     {filename} (in {totaltime:.4f} sec)\n"
+    if result.error:
+        return (
+            f"[Error]         {result.filename} "
+            f"({result.error['type']}: {result.error['message']})\n"
         )
+    elif result.resumed:
+        recorded = "changed" if result.is_changed else "unchanged"
+        return f"[Resumed]       {result.filename} (recorded as {recorded})\n"
+    elif result.skipped:
+        return f"[Skipped]       {result.filename} ({result.skipped})\n"
+    elif not result.is_changed:
+        return f"[Unchanged]     {result.filename} (in {totaltime:.4f} sec)\n"
     else:
-        sys.stderr.write(
+        return (
             "%s    %s ([%d%% of lines are imports] "
             "[source +%dL/-%dL] [%d imports removed in %.4f sec])\n"
             % (
@@ -914,9 +2625,11 @@ def _run_file(options, filename):
                     if not options.diff
                     and not options.statsonly
                     and not options.stdout
+                    and not options.check
+                    and not options.patch
                     else "[Generating]"
                 ),
-                filename,
+                result.filename,
                 stats["import_proportion"],
                 stats["added"],
                 stats["removed"],
@@ -925,44 +2638,1257 @@ def _run_file(options, filename):
             )
         )
 
-    if not options.statsonly:
-        if options.diff:
-            sys.stdout.writelines(
-                difflib.unified_diff(
-                    list(_lines_with_newlines(source_lines)),
-                    list(_lines_with_newlines(result)),
-                    fromfile=filename,
-                    tofile=filename,
+
+class _BufferedWriter:
+    """Collects writes to a stream and writes them out in large chunks,
+    when enough has accumulated or enough time has passed."""
+
+    def __init__(self, stream, size: int = 65536, interval: float = 0.25):
+        self.stream = stream
+        self.size = size
+        self.interval = interval
+        self._chunks: list[str] = []
+        self._pending = 0
+        self._last_flush = time.monotonic()
+
+    def write(self, text: str) -> None:
+        if not text:
+            return
+        self._chunks.append(text)
+        self._pending += len(text)
+        if (
+            self._pending >= self.size
+            or time.monotonic() - self._last_flush >= self.interval
+        ):
+            self.flush()
+
+    def flush(self) -> None:
+        if self._chunks:
+            self.stream.write("".join(self._chunks))
+            self._chunks.clear()
+            self._pending = 0
+        self.stream.flush()
+        self._last_flush = time.monotonic()
+
+
+_STATS_KEYS = (
+    "import_proportion",
+    "added",
+    "removed",
+    "removed_imports",
+    "names_from_star",
+    "totaltime",
+)
+
+
+def _file_record(result: FileResult) -> dict[str, Any]:
+    record: dict[str, Any] = {
+        "type": "file",
+        "filename": result.filename,
+        "is_changed": result.is_changed,
+    }
+    for key in _STATS_KEYS:
+        record[key] = result.stats.get(key)
+    record["bytes_read"] = result.bytes_read
+    record["bytes_written"] = result.bytes_written
+    record["io_wait"] = result.io_wait
+    record["cpu_time"] = result.cpu_time
+    if result.timings is not None:
+        record["timings"] = result.timings
+        record["counters"] = result.counters
+    if result.memory is not None:
+        record["memory"] = result.memory
+    if result.skipped:
+        record["skipped"] = result.skipped
+    if result.guard:
+        record["guard"] = result.guard
+    if result.error:
+        record["error"] = result.error
+    if result.resumed:
+        record["resumed"] = True
+    return record
+
+
+def _memory_key(memory: dict[str, Optional[int]]) -> int:
+    """How memory hungry a file was, for the top files of
+    ``--memory-report``."""
+    if "tracemalloc_peak" in memory:
+        return memory["tracemalloc_peak"] or 0
+    return memory.get("rss_growth") or 0
+
+
+def _mib(size: Optional[int]) -> str:
+    return "-" if size is None else f"{size / (1 << 20):.1f}MiB"
+
+
+def _add_counts(totals: dict, counts: dict) -> None:
+    for key, value in counts.items():
+        totals[key] = totals.get(key, 0) + value
+
+
+def _format_timings(timings: dict, counters: dict) -> str:
+    return (
+        " ".join(
+            f"{name}={seconds * 1000:.2f}ms"
+            for name, seconds in sorted(
+                timings.items(), key=lambda item: -item[1]
+            )
+        )
+        + " | "
+        + " ".join(f"{name}={count}" for name, count in counters.items())
+    )
+
+
+def _percentile(ordered: Sequence[float], percent: float) -> float:
+    """Nearest-rank percentile of an already sorted sequence."""
+    if not ordered:
+        return 0.0
+    rank = max(int(len(ordered) * percent / 100 + 0.5), 1)
+    return ordered[min(rank, len(ordered)) - 1]
+
+
+_Span = tuple[int, int, str, str, float, float]
+
+
+def _trace_document(spans: list[_Span], parent_pid: int) -> dict[str, Any]:
+    """Build a Chrome trace-event document from
+    ``(pid, tid, category, name, start, end)`` spans.
+
+    Times are ``time.perf_counter()`` values, which are taken from the
+    same system-wide clock in the parent and worker processes.
+
+    """
+    base = min(start for *_, start, _ in spans)
+    events: list[dict[str, Any]] = []
+    for pid in sorted({pid for pid, *_ in spans}):
+        events.append(
+            {
+                "name": "process_name",
+                "ph": "M",
+                "pid": pid,
+                "tid": pid,
+                "args": {
+                    "name": (
+                        "zimports" if pid == parent_pid else "zimports worker"
+                    )
+                },
+            }
+        )
+    for pid, tid, category, name, start, end in spans:
+        events.append(
+            {
+                "name": name,
+                "cat": category,
+                "ph": "X",
+                "ts": (start - base) * 1e6,
+                "dur": (end - start) * 1e6,
+                "pid": pid,
+                "tid": tid,
+            }
+        )
+    return {"traceEvents": events, "displayTimeUnit": "ms"}
+
+
+class _ProfileStats:
+    """The raw stats of a worker's profile, in the form that
+    ``pstats.Stats.add()`` accepts."""
+
+    def __init__(self, stats: dict):
+        self.stats = stats
+
+    def create_stats(self) -> None:
+        pass
+
+
+class _Reporter:
+    """Writes the results of all files, in the parent process."""
+
+    def __init__(self, options, workers: int = 1):
+        self.options = options
+        self.workers = workers
+        self.starttime = time.perf_counter()
+        self.stdout = _BufferedWriter(sys.stdout)
+        self.stderr = _BufferedWriter(sys.stderr)
+        if options.patch:
+            self.patch: Optional[_BufferedWriter] = _BufferedWriter(
+                open(options.patch, "w", encoding="utf-8")
+            )
+        else:
+            self.patch = None
+        self.separator = "\0" if options.null else "\n"
+        self.files = 0
+        self.changed = 0
+        self.skipped: list[str] = []
+        self.guarded: list[dict[str, Any]] = []
+        self.errors = 0
+        self.resumed = 0
+        self.total: Optional[int] = None
+        self.bytes_read = 0
+        self.bytes_written = 0
+        self.io_wait = 0.0
+        self.cpu_time = 0.0
+        self.times: list[float] = []
+        self.timings: dict[str, float] = {}
+        self.counters: dict[str, int] = {}
+        self.spans: list[_Span] = []
+        self.profile: Any = None
+        self.samples: dict[str, int] = {}
+        self.worker_rss: dict[int, int] = {}
+        self.file_memory: list[tuple[int, str, dict]] = []
+        self.records: list[dict[str, Any]] = []
+
+    def add(self, result: FileResult) -> None:
+        options = self.options
+        self.files += 1
+        if result.is_changed:
+            self.changed += 1
+        if result.skipped:
+            self.skipped.append(result.filename)
+        if result.error:
+            self.errors += 1
+        if result.resumed:
+            self.resumed += 1
+        if result.guard:
+            self.guarded.append(
+                {
+                    "filename": result.filename,
+                    "guard": result.guard,
+                    "action": "skipped" if result.skipped else "sort_only",
+                }
+            )
+        self.bytes_read += result.bytes_read
+        self.bytes_written += result.bytes_written
+        self.io_wait += result.io_wait
+        self.cpu_time += result.cpu_time
+        self.times.append(result.stats["totaltime"])
+        if result.timings is not None:
+            _add_counts(self.timings, result.timings)
+            _add_counts(self.counters, result.counters)
+        if result.profile is not None:
+            self._add_profile(result.profile)
+        if result.samples is not None:
+            _add_counts(self.samples, result.samples)
+        if result.memory is not None:
+            rss = result.memory["rss_peak"]
+            if rss is not None:
+                self.worker_rss[result.pid] = max(
+                    rss, self.worker_rss.get(result.pid, 0)
+                )
+            self.file_memory.append(
+                (_memory_key(result.memory), result.filename, result.memory)
+            )
+        if result.trace_events is not None:
+            for name, start, end in result.trace_events:
+                self.spans.append(
+                    (
+                        result.pid,
+                        result.tid,
+                        "file" if name == result.filename else "phase",
+                        name,
+                        start,
+                        end,
+                    )
+                )
+
+        if options.list_changed:
+            if result.is_changed:
+                self.stdout.write(result.filename + self.separator)
+            elif result.error:
+                self.stderr.write(_format_status(options, result))
+        elif options.stats_format == "ndjson":
+            import json
+
+            self.stderr.write(json.dumps(_file_record(result)) + "\n")
+        elif options.stats_format == "json":
+            self.records.append(_file_record(result))
+        else:
+            self.stderr.write(_format_status(options, result))
+            if result.timings is not None:
+                self.stderr.write(
+                    "    [Timings]   "
+                    + _format_timings(result.timings, result.counters)
+                    + "\n"
+                )
+
+        if result.diff:
+            self.stdout.write(result.diff)
+        if result.output is not None:
+            self.stdout.write(result.output)
+        if result.patch and self.patch is not None:
+            self.patch.write(result.patch)
+
+    def summary(self) -> dict[str, Any]:
+        elapsed = time.perf_counter() - self.starttime
+        times = sorted(self.times)
+        summary = {
+            "type": "summary",
+            "files": self.files,
+            "changed": self.changed,
+            "errors": self.errors,
+            "resumed": self.resumed,
+            "skipped": self.skipped,
+            "guarded": self.guarded,
+            "workers": self.workers,
+            "elapsed": elapsed,
+            "files_per_sec": self.files / elapsed if elapsed else 0.0,
+            "totaltime": sum(times),
+            "p50": _percentile(times, 50),
+            "p90": _percentile(times, 90),
+            "p99": _percentile(times, 99),
+            "max": times[-1] if times else 0.0,
+            "bytes_read": self.bytes_read,
+            "bytes_written": self.bytes_written,
+            "io_wait": self.io_wait,
+            "cpu_time": self.cpu_time,
+        }
+        if self.options.time_budget:
+            summary["budget"] = {
+                "seconds": self.options.time_budget,
+                "total": self.total,
+                "remaining": self.total - self.files,
+                "coverage": self.files / self.total if self.total else 1.0,
+            }
+        if self.options.timings:
+            summary["timings"] = self.timings
+            summary["counters"] = self.counters
+        if self.options.memory_report:
+            summary["memory"] = {
+                "parent_rss_peak": _peak_rss(),
+                "worker_rss_peak": {
+                    str(pid): rss for pid, rss in self.worker_rss.items()
+                },
+                "top_files": [
+                    {"filename": filename, **memory}
+                    for _, filename, memory in self._top_memory()
+                ],
+            }
+        return summary
+
+    def _top_memory(self) -> list[tuple[int, str, dict]]:
+        import heapq
+
+        return heapq.nlargest(
+            self.options.memory_top,
+            self.file_memory,
+            key=lambda entry: entry[0],
+        )
+
+    def close(self) -> None:
+        if self.options.stats_format in ("json", "ndjson"):
+            import json
+
+            if self.options.stats_format == "json":
+                document = {"files": self.records, "summary": self.summary()}
+                self.stderr.write(json.dumps(document, indent=2) + "\n")
+            else:
+                self.stderr.write(json.dumps(self.summary()) + "\n")
+        elif self.options.timings and not self.options.list_changed:
+            self.stderr.write(
+                f"[Timings]       {self.files} files "
+                + _format_timings(self.timings, self.counters)
+                + "\n"
+            )
+        if self.options.time_budget and self.options.stats_format == "text":
+            self._write_budget()
+        if self.errors and self.options.stats_format == "text":
+            self.stderr.write(
+                f"[Errors]        {self.errors} of {self.files} files failed\n"
+            )
+        if (
+            self.options.stats_format == "text"
+            and not self.options.list_changed
+        ):
+            for entry in self.guarded:
+                self.stderr.write(
+                    f"[Guarded]       {entry['filename']} "
+                    f"(over {entry['guard']}, "
+                    + (
+                        "skipped"
+                        if entry["action"] == "skipped"
+                        else "imports sorted only"
+                    )
+                    + ")\n"
+                )
+        if (
+            self.options.memory_report
+            and self.options.stats_format == "text"
+            and not self.options.list_changed
+        ):
+            self._write_memory_report()
+        if self.options.trace:
+            self._write_trace()
+        if self.profile is not None:
+            self._write_profile()
+        if self.options.sample:
+            with open(self.options.sample, "w", encoding="utf-8") as file_:
+                for stack, count in sorted(self.samples.items()):
+                    file_.write(f"{stack} {count}\n")
+        self.stdout.flush()
+        self.stderr.flush()
+        if self.patch is not None:
+            self.patch.flush()
+            self.patch.stream.close()
+
+    def _write_budget(self) -> None:
+        total = self.total or 0
+        remaining = total - self.files
+        self.stderr.write(
+            f"[Budget]        ran {self.files} of {total} files "
+            f"({self.files / total if total else 1.0:.0%}) in "
+            f"{time.perf_counter() - self.starttime:.1f} sec"
+        )
+        if remaining:
+            self.stderr.write(
+                f"; {remaining} left"
+                + (
+                    ", run again with --resume to carry on"
+                    if self.options.checkpoint
+                    else ", use --checkpoint to be able to carry on"
                 )
             )
-        elif options.stdout or filename == "-":
-            sys.stdout.writelines(_lines_with_newlines(result))
+        self.stderr.write("\n")
+
+    def _write_memory_report(self) -> None:
+        self.stderr.write(
+            f"[Memory]        parent peak RSS {_mib(_peak_rss())}\n"
+        )
+        for pid, rss in sorted(self.worker_rss.items()):
+            self.stderr.write(
+                f"[Memory]        worker {pid} peak RSS {_mib(rss)}\n"
+            )
+        for _, filename, memory in self._top_memory():
+            self.stderr.write(
+                f"[Memory]        {filename} "
+                f"(tracemalloc peak {_mib(memory.get('tracemalloc_peak'))}"
+                f", peak RSS +{_mib(memory.get('rss_growth'))})\n"
+            )
+
+    def _add_profile(self, stats: dict) -> None:
+        if self.profile is None:
+            import pstats
+
+            self.profile = pstats.Stats(
+                _ProfileStats(stats), stream=self.stderr
+            )
         else:
-            if stats["is_changed"]:
-                with open(
-                    filename,
-                    "w",
-                    encoding=encoding_comment if encoding_comment else "utf-8",
-                ) as file_:
-                    file_.writelines(_lines_with_newlines(result))
+            self.profile.add(_ProfileStats(stats))
+
+    def _write_profile(self) -> None:
+        self.profile.dump_stats(self.options.profile)
+        # the table would break up the json of the other formats
+        if self.options.profile_top and self.options.stats_format == "text":
+            self.profile.sort_stats("cumulative").print_stats(
+                self.options.profile_top
+            )
+
+    def _write_trace(self) -> None:
+        import json
+        import threading
+
+        pid = os.getpid()
+        self.spans.append(
+            (
+                pid,
+                threading.get_native_id(),
+                "run",
+                "zimports",
+                self.starttime,
+                time.perf_counter(),
+            )
+        )
+        with open(self.options.trace, "w", encoding="utf-8") as file_:
+            json.dump(_trace_document(self.spans, pid), file_)
 
 
-def run_with_options(options):
-    for filename in options.filename:
+def _iter_filenames(options) -> Iterator[str]:
+    paths: Iterable[str] = options.filename
+    if options.files_from:
+        paths = chain(
+            paths, _read_files_from(options.files_from, options.null)
+        )
+    for filename in paths:
         if os.path.isdir(filename):
+            for root, dirs, files in os.walk(filename):
+                # walk in a consistent order, so that output in path
+                # order is the same from one run to the next
+                dirs.sort()
+                for file in sorted(files):
+                    if file.endswith(".py") or file.endswith(".pyi"):
+                        yield os.path.join(root, file)
+        else:
+            yield filename
+
+
+def _read_files_from(path: str, null: bool) -> Iterator[str]:
+    """Yield the paths listed in the file ``path``, or stdin for ``"-"``,
+    one per line, or separated by NULs if ``null``.
+
+    Paths are yielded as soon as they've been read, so that files can be
+    run while whatever is writing the list is still going.
+
+    """
+    file_ = sys.stdin.buffer if path == "-" else open(path, "rb")
+    try:
+        if null:
+            rest = b""
+            while True:
+                chunk = file_.read1(65536)
+                if not chunk:
+                    break
+                *paths, rest = (rest + chunk).split(b"\0")
+                for name in paths:
+                    if name:
+                        yield os.fsdecode(name)
+            if rest:
+                yield os.fsdecode(rest)
+        else:
+            for line in file_:
+                line = line.rstrip(b"\r\n")
+                if line:
+                    yield os.fsdecode(line)
+    finally:
+        if path != "-":
+            file_.close()
+
+
+def _prioritize(filenames: list[str], roots: Sequence[str]) -> list[str]:
+    """Order files for ``--time-budget``: first those modified since the
+    last commit of their git repository, then those git has changes for,
+    then the rest, and within each of these the most recently modified
+    first.
+
+    The repositories are those of ``roots``, the paths given on the
+    command line, or of the common parent of ``filenames`` if there are
+    none; files outside of all of them are ordered by time alone.
+
+    """
+    if not roots and filenames:
+        try:
+            roots = [
+                os.path.commonpath([os.path.abspath(f) for f in filenames])
+            ]
+        except ValueError:
+            # e.g. on different drives
+            roots = []
+    repos = {}
+    seen = set()
+    for root in roots:
+        if root == "-":
+            continue
+        directory = os.path.realpath(
+            root if os.path.isdir(root) else os.path.dirname(root) or "."
+        )
+        # each repository only once, however many paths are in it
+        if directory in seen or any(
+            directory == toplevel
+            or directory.startswith(os.path.join(toplevel, ""))
+            for toplevel in repos
+        ):
+            continue
+        seen.add(directory)
+        state = _git_state(directory)
+        if state is not None:
+            repos[state[0]] = state[1:]
+    # the innermost repository a file is in, for nested ones
+    toplevels = sorted(repos, key=len, reverse=True)
+
+    def key(filename: str) -> tuple[int, float]:
+        try:
+            mtime = os.stat(filename).st_mtime
+        except OSError:
+            # let running the file report the error
+            mtime = 0.0
+        path = os.path.realpath(filename)
+        for toplevel in toplevels:
+            if path.startswith(os.path.join(toplevel, "")):
+                changed, committed = repos[toplevel]
+                if committed is not None and mtime > committed:
+                    return 0, -mtime
+                elif path in changed:
+                    return 1, -mtime
+                break
+        return 2, -mtime
+
+    return sorted(filenames, key=key)
+
+
+def _git_state(
+    directory: str,
+) -> Optional[tuple[str, set[str], Optional[float]]]:
+    """Return the real path of the git repository ``directory`` is in,
+    the real paths of the files ``git status`` reports for it, and the
+    time of its ``HEAD`` commit, if any; or None outside of a
+    repository."""
+    import subprocess
+
+    def git(*args: str) -> Optional[bytes]:
+        try:
+            proc = subprocess.run(
+                ["git", "-C", directory, *args],
+                stdout=subprocess.PIPE,
+                stderr=subprocess.DEVNULL,
+                check=True,
+            )
+        except (OSError, subprocess.CalledProcessError):
+            return None
+        return proc.stdout
+
+    toplevel = git("rev-parse", "--show-toplevel")
+    if toplevel is None:
+        return None
+    root = os.path.realpath(os.fsdecode(toplevel.strip()))
+
+    changed = set()
+    status = git("status", "--porcelain=v1", "-z", "--untracked-files=all")
+    # each entry is "XY path", followed by the original path for renames;
+    # paths are relative to the top of the repository
+    entries = iter((status or b"").split(b"\0"))
+    for entry in entries:
+        if len(entry) > 3:
+            changed.add(
+                os.path.realpath(os.path.join(root, os.fsdecode(entry[3:])))
+            )
+            if entry[:1] in (b"R", b"C"):
+                next(entries, None)
+
+    head = git("log", "-1", "--format=%ct")
+    committed = float(head) if head and head.strip() else None
+    return root, changed, committed
 
-            def iter_files():
-                for root, dirs, files in os.walk(filename):
-                    for file in files:
-                        if file.endswith(".py") or file.endswith(".pyi"):
-                            yield os.path.join(root, file)
 
-            if options.workers is None or options.workers <= 1:
-                for file in iter_files():
-                    _run_file(options, file)
+#: with ``--workers auto``, the fewest files worth giving a worker; below
+#: this, starting a process costs more than it saves
+_FILES_PER_WORKER = 4
+
+#: the size of the batches that files streamed from ``--files-from`` are
+#: handed to workers in, as how many there will be isn't known up front
+_STREAM_CHUNKSIZE = 16
+
+
+def _cgroup_cpus() -> Optional[int]:
+    """The number of CPUs our cgroup's quota allows, or None if there's
+    no quota or it can't be read."""
+    for quota_path, period_path in (
+        # cgroup v2 has both in one file, then v1
+        ("/sys/fs/cgroup/cpu.max", None),
+        (
+            "/sys/fs/cgroup/cpu/cpu.cfs_quota_us",
+            "/sys/fs/cgroup/cpu/cpu.cfs_period_us",
+        ),
+    ):
+        try:
+            with open(quota_path) as file_:
+                values = file_.read().split()
+            if period_path is not None:
+                with open(period_path) as file_:
+                    values.append(file_.read().strip())
+            quota, period = values[0], int(values[1])
+            if quota == "max" or int(quota) <= 0:
+                return None
+            return max(-(-int(quota) // period), 1)
+        except (OSError, ValueError, IndexError):
+            continue
+    return None
+
+
+def _available_cpus() -> int:
+    """The number of CPUs this process can actually use, taking CPU
+    affinity and cgroup CPU quotas into account."""
+    if hasattr(os, "sched_getaffinity"):
+        cpus = len(os.sched_getaffinity(0))
+    else:
+        cpus = os.cpu_count() or 1
+    quota = _cgroup_cpus()
+    if quota is not None:
+        cpus = min(cpus, quota)
+    return max(cpus, 1)
+
+
+def _worker_count(options, filenames: Iterable[str]) -> int:
+    if not isinstance(filenames, list):
+        # streamed from --files-from, and longer than _peek_stream() reads
+        if options.workers == "auto":
+            return _available_cpus()
+        return options.workers
+    # stdin isn't available to worker processes
+    if len(filenames) < 2 or "-" in filenames:
+        return 1
+    if options.workers == "auto":
+        return max(
+            min(_available_cpus(), len(filenames) // _FILES_PER_WORKER), 1
+        )
+    return max(min(options.workers, len(filenames)), 1)
+
+
+def _peek_stream(filenames: Iterator[str]) -> Iterable[str]:
+    """Read ahead in names streamed from ``--files-from`` with ``--workers
+    auto``, far enough to tell whether there are enough of them to be
+    worth starting workers for; if the stream ends before that, the names
+    are returned as a list, which gets sized like any other."""
+    head = list(islice(filenames, _FILES_PER_WORKER * 2))
+    if len(head) < _FILES_PER_WORKER * 2:
+        return head
+    return chain(head, filenames)
+
+
+_CGROUP_ROOT = "/sys/fs/cgroup"
+
+
+def _cgroup_memory() -> Optional[tuple[int, int]]:
+    """The memory usage and limit of our cgroup in bytes, or None if
+    there's no limit or it can't be read.
+
+    Usage doesn't count the inactive page cache, which the kernel
+    reclaims before it runs out of memory, the same as the working set
+    reported by docker and the kubelet; otherwise a long run over a big
+    tree fills the cache and looks like it's near the limit.
+
+    """
+    for usage_name, limit_name, stat_name, inactive_key in (
+        # cgroup v2, then v1
+        ("memory.current", "memory.max", "memory.stat", "inactive_file"),
+        (
+            "memory/memory.usage_in_bytes",
+            "memory/memory.limit_in_bytes",
+            "memory/memory.stat",
+            "total_inactive_file",
+        ),
+    ):
+        try:
+            with open(os.path.join(_CGROUP_ROOT, limit_name)) as file_:
+                limit = file_.read().strip()
+            if limit == "max":
+                return None
+            with open(os.path.join(_CGROUP_ROOT, usage_name)) as file_:
+                usage = int(file_.read())
+        except (OSError, ValueError):
+            continue
+        try:
+            with open(os.path.join(_CGROUP_ROOT, stat_name)) as file_:
+                for line in file_:
+                    key, _, value = line.partition(" ")
+                    if key == inactive_key:
+                        usage = max(usage - int(value), 0)
+                        break
+        except (OSError, ValueError):
+            pass
+        try:
+            return usage, int(limit)
+        except ValueError:
+            continue
+    return None
+
+
+def _run_batch(options: Any, batch: _Batch) -> list[tuple[int, FileResult]]:
+    return list(_iter_batch(options, batch))
+
+
+def _worker_main(
+    conn: Any, options: Any, max_tasks: int, max_rss: Optional[int]
+) -> None:
+    """Run batches of files sent by :class:`._WorkerPool`, until told to
+    stop or until this worker is due to be replaced."""
+    done = 0
+    while True:
+        batch = conn.recv()
+        if batch is None:
+            return
+        results = _run_batch(options, batch)
+        done += len(batch)
+        retire = bool(max_tasks and done >= max_tasks) or bool(
+            max_rss and (_peak_rss() or 0) >= max_rss
+        )
+        conn.send((results, retire))
+        if retire:
+            return
+
+
+@dc.dataclass
+class _Worker:
+    process: Any
+    conn: Any
+    batch: Optional[_Batch] = None
+
+
+class _WorkerPool:
+    """Runs batches of files in worker processes.
+
+    Unlike ``multiprocessing.Pool``, a worker is replaced once it has run
+    ``--max-tasks-per-worker`` files, or once its RSS has passed
+    ``--max-worker-rss``, so that modules imported by ``--expand-stars``
+    don't accumulate without bound.  When the memory usage of our cgroup
+    passes ``--memory-high`` of its limit, workers that are idle are shut
+    down and fewer batches are run at once, until usage drops again.
+
+    """
+
+    #: how often to look at the cgroup's memory usage, in seconds
+    check_interval = 0.25
+
+    def __init__(self, options: Any, workers: int):
+        self.options = options
+        self.workers = workers
+        self.max_tasks = options.max_tasks_per_worker
+        self.max_rss = (
+            int(options.max_worker_rss * (1 << 20))
+            if options.max_worker_rss
+            else None
+        )
+        self.limit = workers
+        self.idle: list[_Worker] = []
+        self.busy: dict[Any, _Worker] = {}
+        self._retried: set[int] = set()
+        self._checked = 0.0
+
+    def _spawn(self) -> _Worker:
+        from multiprocessing import Pipe
+        from multiprocessing import Process
+
+        parent_conn, child_conn = Pipe()
+        process = Process(
+            target=_worker_main,
+            args=(child_conn, self.options, self.max_tasks, self.max_rss),
+            daemon=True,
+        )
+        process.start()
+        child_conn.close()
+        return _Worker(process, parent_conn)
+
+    def _stop(self, worker: _Worker) -> None:
+        try:
+            worker.conn.send(None)
+        except OSError:
+            pass
+        worker.conn.close()
+        worker.process.join()
+
+    def _concurrency(self) -> int:
+        high = self.options.memory_high
+        if not high:
+            return self.workers
+        now = time.monotonic()
+        if now - self._checked >= self.check_interval:
+            self._checked = now
+            memory = _cgroup_memory()
+            if memory is not None:
+                usage, limit = memory
+                if usage >= limit * high:
+                    self.limit = max(self.limit - 1, 1)
+                elif usage < limit * (high - 0.1):
+                    self.limit = min(self.limit + 1, self.workers)
+        return self.limit
+
+    def run(
+        self, batches: Iterable[_Batch]
+    ) -> Iterator[tuple[int, FileResult]]:
+        """Run the batches, yielding ``(index, result)`` for each file as
+        results arrive.  ``batches`` may be a generator; a batch is only
+        taken from it when there's a worker free to run it.
+
+        If a worker dies while running a batch, each of its files is run
+        again on its own; a file whose worker dies once more gets an
+        error result.
+
+        """
+        from collections import deque
+        from multiprocessing.connection import wait
+
+        batches = iter(batches)
+        pending: Any = deque()
+        while True:
+            limit = self._concurrency()
+            while len(self.busy) < limit:
+                batch = pending.popleft() if pending else next(batches, None)
+                if batch is None:
+                    break
+                worker = self.idle.pop() if self.idle else self._spawn()
+                worker.batch = batch
+                worker.conn.send(worker.batch)
+                self.busy[worker.conn] = worker
+            while self.idle and len(self.idle) + len(self.busy) > limit:
+                self._stop(self.idle.pop())
+            if not self.busy:
+                return
+
+            for conn in wait(list(self.busy)):
+                worker = self.busy.pop(conn)
+                batch = worker.batch
+                assert batch is not None
+                try:
+                    results, retire = conn.recv()
+                except EOFError:
+                    # the worker died, likely killed for running out of
+                    # memory.  try each of its files again in a new worker
+                    worker.process.join()
+                    conn.close()
+                    if len(batch) == 1 and batch[0][0] in self._retried:
+                        index, filename = batch[0]
+                        yield index, _error_result(
+                            filename,
+                            RuntimeError(
+                                "worker exited with code %s"
+                                % worker.process.exitcode
+                            ),
+                            0.0,
+                        )
+                        continue
+                    for item in reversed(batch):
+                        self._retried.add(item[0])
+                        pending.appendleft([item])
+                    continue
+
+                worker.batch = None
+                if retire:
+                    conn.close()
+                    worker.process.join()
+                else:
+                    self.idle.append(worker)
+                yield from results
+
+    def close(self) -> None:
+        for worker in self.busy.values():
+            worker.process.terminate()
+            worker.process.join()
+            worker.conn.close()
+        self.busy.clear()
+        while self.idle:
+            self._stop(self.idle.pop())
+
+
+class _FuturesPool:
+    """Runs batches of files on a ``concurrent.futures`` executor; this is
+    used for the thread and subinterpreter executors."""
+
+    def __init__(self, options: Any, executor: Any, workers: int):
+        self.options = options
+        self.executor = executor
+        self.workers = workers
+
+    def run(
+        self, batches: Iterable[_Batch]
+    ) -> Iterator[tuple[int, FileResult]]:
+        from concurrent.futures import FIRST_COMPLETED
+        from concurrent.futures import wait
+
+        # keep each worker supplied with a batch and another waiting,
+        # taking batches from the generator only as they're needed
+        batches = iter(batches)
+        running: set[Any] = set()
+        while True:
+            for batch in batches:
+                running.add(
+                    self.executor.submit(_run_batch, self.options, batch)
+                )
+                if len(running) >= self.workers * 2:
+                    break
+            if not running:
+                return
+            done, running = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                yield from future.result()
+
+    def close(self) -> None:
+        self.executor.shutdown(wait=True, cancel_futures=True)
+
+
+def _make_pool(options: Any, workers: int) -> Any:
+    """Create the pool for ``--executor``, which has ``run()`` and
+    ``close()`` methods like those of :class:`._WorkerPool`."""
+    if options.executor == "thread":
+        from concurrent.futures import ThreadPoolExecutor
+
+        return _FuturesPool(options, ThreadPoolExecutor(workers), workers)
+    elif options.executor == "interpreter":
+        from concurrent.futures import (  # type: ignore[attr-defined]
+            InterpreterPoolExecutor,
+        )
+
+        return _FuturesPool(options, InterpreterPoolExecutor(workers), workers)
+    else:
+        return _WorkerPool(options, workers)
+
+
+def _run_files(
+    options, filenames: Iterable[str], deadline: Optional[float] = None
+) -> Iterator[FileResult]:
+    """Run each file, yielding its result.
+
+    Files are run on the ``--executor`` pool if there's more than one of
+    them and more than one worker.  ``filenames`` is either a list, or an
+    iterator of names streamed from ``--files-from``, which is consumed
+    only as workers become free.  Results are yielded in the order of
+    ``filenames``, unless ``--output-order completed`` was given, in
+    which case they're yielded as they complete.  Closing the generator
+    early terminates the pool along with any work still outstanding.
+
+    Once ``time.perf_counter()`` passes ``deadline``, no more files are
+    started; those already running are finished.
+
+    """
+    workers = _worker_count(options, filenames)
+    indexed = enumerate(
+        filenames if deadline is None else _until(deadline, filenames)
+    )
+    if workers == 1:
+        for _, result in _iter_batch(options, indexed):
+            yield result
+        return
+
+    if options.fail_fast or deadline is not None:
+        # hand out one file at a time so that there's little work to
+        # throw away once a changed file is found, or to overrun the
+        # deadline with
+        chunksize = 1
+    elif isinstance(filenames, list):
+        chunksize = max(len(filenames) // (workers * 4), 1)
+    else:
+        chunksize = _STREAM_CHUNKSIZE
+    if options.max_tasks_per_worker:
+        chunksize = min(chunksize, options.max_tasks_per_worker)
+
+    pool = _make_pool(options, workers)
+    try:
+        waiting: dict[int, Any] = {}
+        next_index = 0
+        for index, result in pool.run(_iter_batches(indexed, chunksize)):
+            if options.output_order == "completed":
+                waiting[next_index] = result
             else:
-                func = partial(_run_file, options)
-                with Pool(options.workers) as pool:
-                    pool.map(func, iter_files())
+                waiting[index] = result
+            while next_index in waiting:
+                result = waiting.pop(next_index)
+                next_index += 1
+                yield result
+    finally:
+        pool.close()
+
+
+def _until(deadline: float, filenames: Iterable[str]) -> Iterator[str]:
+    for filename in filenames:
+        if time.perf_counter() >= deadline:
+            return
+        yield filename
+
+
+def _iter_batches(
+    indexed: Iterable[tuple[int, str]], chunksize: int
+) -> Iterator[_Batch]:
+    batch: _Batch = []
+    for item in indexed:
+        batch.append(item)
+        if len(batch) == chunksize:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+#: the options that change what's done with a file, which a checkpoint
+#: has to have been written with to be resumed from
+_CHECKPOINT_OPTIONS = (
+    "application_import_names",
+    "application_package_names",
+    "black_line_length",
+    "check",
+    "diff",
+    "expand_stars",
+    "generated_markers",
+    "heuristic_unused",
+    "keep_unused",
+    "keep_unused_type_checking",
+    "large_file_size",
+    "max_file_size",
+    "multi_imports",
+    "patch",
+    "per_file_ignores",
+    "statsonly",
+    "stdout",
+    "style",
+)
+
+
+def _options_fingerprint(options) -> str:
+    import json
+
+    from . import __version__
+
+    values = {
+        name: getattr(options, name, None) for name in _CHECKPOINT_OPTIONS
+    }
+    values["version"] = __version__
+    return _digest(json.dumps(values, sort_keys=True, default=str).encode())
+
+
+class _Checkpoint:
+    """Records the files that have been run in ``--checkpoint``, so that a
+    later run with ``--resume`` can skip those that haven't changed.
+
+    The checkpoint is a log of JSON lines.  The first holds a
+    ``fingerprint`` of the version and the options that change what's
+    done with a file (see :data:`._CHECKPOINT_OPTIONS`); a checkpoint
+    written with a different fingerprint isn't resumed from: that raises
+    :class:`ValueError`, leaving the checkpoint as it was, rather than
+    losing what it recorded.  Each line after it has a file's
+    ``path``, the ``digest`` of its content once it was run, and whether
+    it ``is_changed``; later lines take precedence.  Lines are buffered
+    and appended at most every ``--checkpoint-interval`` seconds, so that
+    recording them costs little more than the writes themselves.
+
+    """
+
+    def __init__(self, path: str, interval: float, resume: bool, options):
+        self.path = path
+        self.interval = interval
+        self.fingerprint = _options_fingerprint(options)
+        self.entries: dict[str, tuple[str, bool]] = {}
+        self.pending: list[str] = []
+        self.flushed = time.monotonic()
+        status = self._load() if resume else None
+        if status is None:
+            import json
+
+            self.file = open(path, "w", encoding="utf-8")
+            self.file.write(
+                json.dumps({"fingerprint": self.fingerprint}) + "\n"
+            )
+            self.file.flush()
         else:
-            _run_file(options, filename)
+            self.file = open(path, "a", encoding="utf-8")
+            if status == "cut short":
+                self.file.write("\n")
+
+    def _load(self) -> Optional[str]:
+        """Read the entries of the checkpoint.  Returns None if there's
+        nothing to resume from, "cut short" if its last line was cut
+        short by the run that wrote it being killed, otherwise "ok".
+        Raises ValueError if it was written with another fingerprint."""
+        import json
+
+        try:
+            file_ = open(self.path, encoding="utf-8")
+        except FileNotFoundError:
+            return None
+        with file_:
+            try:
+                header = json.loads(file_.readline())
+            except ValueError:
+                header = None
+            if (
+                not isinstance(header, dict)
+                or header.get("fingerprint") != self.fingerprint
+            ):
+                raise ValueError(
+                    f"{self.path} was written with different options or "
+                    "by another version; resume with the same options, or "
+                    "run without --resume to start it over"
+                )
+            line = ""
+            for line in file_:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    continue
+                self.entries[entry["path"]] = (
+                    entry["digest"],
+                    entry["is_changed"],
+                )
+        return "cut short" if line and not line.endswith("\n") else "ok"
+
+    def add(self, result: FileResult) -> None:
+        import json
+
+        if (
+            result.digest is None
+            or result.resumed
+            # how far a file got depended on how long it took, so it's
+            # tried again
+            or result.guard == "--per-file-timeout"
+        ):
+            return
+        self.pending.append(
+            json.dumps(
+                {
+                    "path": result.filename,
+                    "digest": result.digest,
+                    "is_changed": result.is_changed,
+                }
+            )
+            + "\n"
+        )
+        if time.monotonic() - self.flushed >= self.interval:
+            self.flush()
+
+    def flush(self) -> None:
+        if self.pending:
+            self.file.write("".join(self.pending))
+            self.file.flush()
+            self.pending.clear()
+        self.flushed = time.monotonic()
+
+    def close(self) -> None:
+        self.flush()
+        self.file.close()
+
+
+def run_with_options(options) -> int:
+    """Run zimports over the files and directories in ``options``.
+
+    Returns the process exit status: 2 if any file failed, otherwise with
+    ``--check``, 1 if any file would be changed.
+
+    """
+    deadline = None
+    if options.time_budget:
+        deadline = time.perf_counter() + options.time_budget
+
+    filenames: Iterable[str] = _iter_filenames(options)
+    if options.time_budget:
+        filenames = _prioritize(list(filenames), options.filename)
+    elif not options.files_from:
+        filenames = list(filenames)
+    elif options.workers == "auto":
+        filenames = _peek_stream(filenames)
+    checkpoint = None
+    if options.checkpoint:
+        try:
+            checkpoint = _Checkpoint(
+                options.checkpoint,
+                options.checkpoint_interval,
+                options.resume,
+                options,
+            )
+        except ValueError as err:
+            sys.stderr.write(f"zimports: error: {err}\n")
+            return 2
+        # the workers get the entries to resume from along with the
+        # options, and look files up in them as they're read
+        options.resume_from = checkpoint.entries
+        if options.diff or options.patch or _to_stdout(options):
+            # what's output for a changed file can only come from running
+            # it again
+            options.resume_from = {
+                path: entry
+                for path, entry in checkpoint.entries.items()
+                if not entry[1]
+            }
+
+    reporter = _Reporter(options, _worker_count(options, filenames))
+    if isinstance(filenames, list):
+        reporter.total = len(filenames)
+    results = _run_files(options, filenames, deadline)
+    try:
+        for result in results:
+            reporter.add(result)
+            if checkpoint is not None:
+                checkpoint.add(result)
+            if options.fail_fast and result.is_changed:
+                break
+    finally:
+        results.close()
+        reporter.close()
+        if checkpoint is not None:
+            checkpoint.close()
+
+    if reporter.errors:
+        return 2
+    return 1 if options.check and reporter.changed else 0